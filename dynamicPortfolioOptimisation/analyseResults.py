@@ -1,80 +1,61 @@
-import csv
-import math
-from scipy.stats import norm
+import numpy as np
+import pandas as pd
+from scipy.special import ndtr
 from utils import LOCAL_PATH
 
 
 def read_csv_files(file_paths):
-    data = []
-    for file_path in file_paths:
-        with open(file_path, "r") as file:
-            csv_reader = csv.reader(file)
-            for row in csv_reader:
-                data.append(row)
-    return data
+    return pd.concat(
+        [pd.read_csv(file_path, header=None, engine="c") for file_path in file_paths],
+        ignore_index=True,
+    )
 
 
 def analyze_data(data):
-    combinations = {}
-    for row in data:
-        utility_function_name = float(row[0])
-        income_name = row[1]
-        final_utility_only = int(row[2])
-        if final_utility_only:
-            continue
+    df = pd.DataFrame(data)
+    df = df[df[2].astype(int) == 0]
 
-        utility_value = float(row[3].split(" ")[-1])
-        matching_utility_value = float(row[4].split(" ")[-1])
-
-        key = (utility_function_name, income_name, final_utility_only)
-        if key not in combinations:
-            combinations[key] = {
-                "utility_gt_matching": 0,
-                "utility_lt_matching": 0,
-                "total_experiments": 0,
+    utility_values = df[3].astype(str).str.rsplit(" ", n=1).str[-1].astype(float)
+    matching_utility_values = (
+        df[4].astype(str).str.rsplit(" ", n=1).str[-1].astype(float)
+    )
+    combinations = (
+        pd.DataFrame(
+            {
+                "utility_function_name": df[0].astype(float),
+                "income_name": df[1],
+                "final_utility_only": df[2].astype(int),
+                "utility_gt_matching": utility_values > matching_utility_values,
+                "utility_lt_matching": utility_values < matching_utility_values,
+                "total_experiments": 1,
             }
+        )
+        .groupby(["utility_function_name", "income_name", "final_utility_only"])
+        .sum()
+    )
+    keys = [*combinations.index, (1e9, 1e9, 1e9)]
+    counts = combinations[
+        ["utility_gt_matching", "utility_lt_matching", "total_experiments"]
+    ].to_numpy(dtype=int)
+    counts = np.vstack([counts, counts.sum(axis=0)])
 
-        if utility_value > matching_utility_value:
-            combinations[key]["utility_gt_matching"] += 1
-        elif utility_value < matching_utility_value:
-            combinations[key]["utility_lt_matching"] += 1
-        combinations[key]["total_experiments"] += 1
-
-    combinations[1e9, 1e9, 1e9] = {
-        "utility_gt_matching": sum(
-            value["utility_gt_matching"] for value in combinations.values()
-        ),
-        "utility_lt_matching": sum(
-            value["utility_lt_matching"] for value in combinations.values()
-        ),
-        "total_experiments": sum(
-            value["total_experiments"] for value in combinations.values()
-        ),
-    }
-
-    table_data = []
-    for key, value in combinations.items():
-        utility_function_name, income_name, final_utility_only = key
-        utility_gt_matching = value["utility_gt_matching"]
-        utility_lt_matching = value["utility_lt_matching"]
-        total_experiments = value["total_experiments"]
-        proportion = utility_gt_matching / total_experiments
-        z_score = (proportion - 0.5) / math.sqrt(0.5 * 0.5 / total_experiments)
-        p_value = 2 * (1 - norm.cdf(abs(z_score)))
+    utility_gt_matching, utility_lt_matching, total_experiments = counts.T
+    proportion = utility_gt_matching / total_experiments
+    z_score = (proportion - 0.5) / np.sqrt(0.5 * 0.5 / total_experiments)
+    p_value = 2.0 * (1.0 - ndtr(np.abs(z_score)))
 
-        table_data.append(
-            [
-                utility_function_name,
-                income_name,
-                final_utility_only,
-                utility_gt_matching,
-                utility_lt_matching,
-                total_experiments,
-                proportion,
-                z_score,
-                p_value,
-            ]
+    table_data = [
+        list(row)
+        for row in zip(
+            *zip(*keys),
+            utility_gt_matching.tolist(),
+            utility_lt_matching.tolist(),
+            total_experiments.tolist(),
+            proportion.tolist(),
+            z_score.tolist(),
+            p_value.tolist(),
         )
+    ]
 
     table_data.sort(key=lambda x: (x[0], x[1], x[2]))
     return table_data
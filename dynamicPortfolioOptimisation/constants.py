@@ -6,3 +6,4 @@ PROBABILITY_THR = 1e-3 / TOTAL_STEPS
 MAX_LEVERAGE = 3.0
 ALLOW_SHORT = False
 MIN_VISUALIZE_STEPS = 200
+DP_THREADS = 1
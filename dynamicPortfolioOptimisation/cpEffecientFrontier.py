@@ -25,20 +25,27 @@ def find_efficient_frontier(means, stds, correlation):
     )
     covariance_matrix = np.outer(std_devs, std_devs) * corr_matrix
     weights = cp.Variable(len(assets))
+    gamma = cp.Parameter(nonneg=True)
     portfolio_return = cp.sum(cp.multiply(returns, weights))
     portfolio_variance = cp.quad_form(weights, covariance_matrix)
-    efficient_frontier = []
-
-    for gamma in np.linspace(1e-1, 10, 201):
-        # Objective: minimize variance - gamma * return
-        objective = cp.Minimize(portfolio_variance - gamma * portfolio_return)
-        constraints = [
+    # Objective: minimize variance - gamma * return
+    # The problem is built once and re-solved for each gamma, so CVXPY only
+    # canonicalizes it on the first solve. Each solve starts cold, as a fresh
+    # problem would, so the points match separately built problems exactly.
+    problem = cp.Problem(
+        cp.Minimize(portfolio_variance - gamma * portfolio_return),
+        [
             cp.sum(weights) == 1,
             MAX_LEVERAGE >= weights,
             weights[:-1] >= (-MAX_LEVERAGE if ALLOW_SHORT else 0.0),
             weights[-1] >= -MAX_LEVERAGE + 1,
-        ]
-        cp.Problem(objective, constraints).solve()
+        ],
+    )
+    efficient_frontier = []
+
+    for gammaValue in np.linspace(1e-1, 10, 201):
+        gamma.value = gammaValue
+        problem.solve(warm_start=False)
 
         if efficient_frontier and portfolio_return.value <= efficient_frontier[-1][1]:
             break
@@ -1,4 +1,4 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Dict, List, Tuple
 
 import numpy as np
@@ -21,8 +21,17 @@ def logToNumber(log: float) -> float:
     return LOG_BASE ** (log - NEGATIVE_STEPS) * MONEY_BASE
 
 
-numberToLogArray = np.vectorize(numberToLog)
-logToNumberArray = np.vectorize(logToNumber)
+def numberToLogArray(numbers: np.ndarray) -> np.ndarray:
+    return np.log(np.asarray(numbers) / MONEY_BASE) / np.log(LOG_BASE) + NEGATIVE_STEPS
+
+
+def logToNumberArray(logs: np.ndarray) -> np.ndarray:
+    return MONEY_BASE * np.power(LOG_BASE, np.asarray(logs) - NEGATIVE_STEPS)
+
+
+_INDICES = np.arange(TOTAL_STEPS)
+_VALUES = logToNumberArray(_INDICES)
+_LOGNORM_BOUNDARIES = logToNumberArray(_INDICES + 0.5) / MONEY_BASE
 
 
 @dataclass
@@ -34,6 +43,8 @@ class Distribution:
     probabilities: np.ndarray | None = None
 
     portfolio: Dict[str, float] = None
+    significantIndices: np.ndarray = field(init=False, repr=False)
+    significantProbabilities: np.ndarray = field(init=False, repr=False)
 
     def __post_init__(self):
         self.probabilities = (
@@ -41,27 +52,28 @@ class Distribution:
             if self.probabilities is not None
             else np.zeros(self.TOTAL_STEPS)
         )
+        mask = self.probabilities > PROBABILITY_THR
+        self.significantIndices = np.flatnonzero(mask).astype(np.int32)
+        self.significantProbabilities = self.probabilities[mask].astype(np.float64)
+        if self.significantProbabilities.size:
+            self.significantProbabilities /= self.significantProbabilities.sum()
 
     def mean(self) -> float:
-        return np.dot(np.arange(self.TOTAL_STEPS), self.probabilities)
+        return self.probabilities @ _INDICES
 
     def meanAbsolute(self) -> float:
-        return np.dot(logToNumberArray(np.arange(self.TOTAL_STEPS)), self.probabilities)
+        return self.probabilities @ _VALUES
 
     def std(self) -> float:
-        indices = np.arange(self.TOTAL_STEPS)
-        return np.sqrt(np.dot((indices - self.mean()) ** 2, self.probabilities))
+        mean = self.mean()
+        return np.sqrt(self.probabilities @ (_INDICES - mean) ** 2)
 
     def stdAbsolute(self) -> float:
-        values = logToNumberArray(np.arange(self.TOTAL_STEPS))
-        return np.sqrt(np.dot((values - self.meanAbsolute()) ** 2, self.probabilities))
-
-    def getSignificantProbabilities(self) -> List[Tuple[int, float]]:
-        return zip(
-            np.where(self.probabilities > PROBABILITY_THR)[0],
-            self.probabilities[self.probabilities > PROBABILITY_THR]
-            / sum(self.probabilities[self.probabilities > PROBABILITY_THR]),
-        )
+        meanAbsolute = self.meanAbsolute()
+        return np.sqrt(self.probabilities @ (_VALUES - meanAbsolute) ** 2)
+
+    def getSignificantProbabilities(self) -> Tuple[np.ndarray, np.ndarray]:
+        return self.significantIndices, self.significantProbabilities
 
     def print(self) -> None:
         for idx, probability in enumerate(self.probabilities):
@@ -73,28 +85,39 @@ class Distribution:
 
 def utility(stdMult: float, distribution: Distribution) -> float:
     probabilities = distribution.probabilities
-    indices = np.arange(distribution.TOTAL_STEPS)
-    meanValue = np.dot(indices, probabilities)
-    standardDeviation = np.sqrt(np.dot((indices - meanValue) ** 2, probabilities))
+    meanValue = probabilities @ _INDICES
+    standardDeviation = np.sqrt(probabilities @ (_INDICES - meanValue) ** 2)
 
     return meanValue - stdMult * standardDeviation
 
 
 def utilityAbsolute(stdMult: float, distribution: Distribution) -> float:
     probabilities = distribution.probabilities
-    indices = np.arange(distribution.TOTAL_STEPS)
-    values = logToNumberArray(indices)
-    meanValue = np.dot(values, probabilities)
-    standardDeviation = np.sqrt(np.dot((values - meanValue) ** 2, probabilities))
+    meanValue = probabilities @ _VALUES
+    standardDeviation = np.sqrt(probabilities @ (_VALUES - meanValue) ** 2)
 
     return meanValue - stdMult * standardDeviation
 
 
 def getLognormDistribution(mean: float, std: float) -> Distribution:
-    x = logToNumberArray(np.arange(TOTAL_STEPS) + 0.5) / MONEY_BASE
-    cdf_values = stats.lognorm.cdf(x, s=std, scale=np.exp(mean))
+    cdf_values = stats.lognorm.cdf(_LOGNORM_BOUNDARIES, s=std, scale=np.exp(mean))
     pdf_values = np.diff(cdf_values, prepend=0.0)
-    pdf_values /= sum(pdf_values)
+    pdf_values /= pdf_values.sum()
     dist = Distribution(probabilities=pdf_values)
 
     return dist
+
+
+def packSignificantProbabilities(
+    distributions: List[Distribution],
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    significantIndices, significantProbabilities = zip(
+        *(dist.getSignificantProbabilities() for dist in distributions)
+    )
+    offsets = np.cumsum([0] + [len(indices) for indices in significantIndices])
+
+    return (
+        np.concatenate(significantIndices).astype(np.int64),
+        np.concatenate(significantProbabilities),
+        offsets.astype(np.int64),
+    )
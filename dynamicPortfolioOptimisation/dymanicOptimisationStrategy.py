@@ -1,14 +1,23 @@
-from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 import datetime
 from typing import Callable, List, Tuple
 
+import numpy as np
+from numba import njit
 from tqdm import tqdm
 
-from dynamicPortfolioOptimisation.constants import NEGATIVE_STEPS, TOTAL_STEPS
+from dynamicPortfolioOptimisation.constants import (
+    DP_THREADS,
+    NEGATIVE_STEPS,
+    TOTAL_STEPS,
+)
 from dynamicPortfolioOptimisation.distribution import (
     Distribution,
-    logToNumber,
+    logToNumberArray,
     numberToLog,
+    numberToLogArray,
+    packSignificantProbabilities,
 )
 from dynamicPortfolioOptimisation.expectedDistributions import getExpectedDistributions
 from plots.plotUtils import getCommonDates
@@ -20,6 +29,73 @@ from strategy import (
     getBasketFromStockExposures,
 )
 
+INDEX_TO_INSTRUMENT = {
+    "^IXIC": "QQQ",
+    "^GSPC": "SPY",
+    "^DJI": "DIA",
+    "^NYA": "VTI",
+    "^RUT": "IWM",
+    "VBMFX": "BND",
+}
+
+ASSET_CLASS_INSTRUMENTS = {
+    "equity": "^GSPC",
+    "bond": "TLT",
+    "gold": "GLD",
+}
+
+PORTFOLIO_WEIGHT_NAMES = ["leverage", *ASSET_CLASS_INSTRUMENTS]
+
+
+def getPortfolioWeights(distributions: List[Distribution]) -> np.ndarray:
+    return np.array(
+        [
+            [
+                sum(distribution.portfolio.values()),
+                *(
+                    distribution.portfolio.get(instrument, 0.0)
+                    for instrument in ASSET_CLASS_INSTRUMENTS.values()
+                ),
+            ]
+            for distribution in distributions
+        ]
+    )
+
+
+def getMoneyAfterIncomeLookup(income: float) -> np.ndarray:
+    # Indexed by money + idx, i.e. moneyAfterMove + NEGATIVE_STEPS, so that
+    # moneys which fall below zero before the income arrives are covered too.
+    moneyAfterMove = np.arange(2 * TOTAL_STEPS - 1) - NEGATIVE_STEPS
+    moneyAfterIncome = np.round(
+        numberToLogArray(logToNumberArray(moneyAfterMove) + income)
+    )
+    return moneyAfterIncome.clip(0, TOTAL_STEPS - 1).astype(np.int64)
+
+
+@njit(cache=True, nogil=True)
+def getBestDistribution(
+    statesAfterIncome: np.ndarray,
+    stateUtilities: np.ndarray,
+    significantProbabilities: np.ndarray,
+    offsets: np.ndarray,
+    lowerBoundDistIdx: int,
+    upperBoundDistIdx: int,
+) -> Tuple[float, int]:
+    bestUtility = -np.inf
+    bestPortfolioIdx = lowerBoundDistIdx
+    for idxDist in range(lowerBoundDistIdx, upperBoundDistIdx + 1):
+        start, end = offsets[idxDist], offsets[idxDist + 1]
+        finalUtility = np.dot(
+            significantProbabilities[start:end],
+            stateUtilities[statesAfterIncome[start:end]],
+        )
+
+        if finalUtility > bestUtility:
+            bestUtility = finalUtility
+            bestPortfolioIdx = idxDist
+
+    return bestUtility, bestPortfolioIdx
+
 
 class DynamicOptimisationStrategy(Strategy):
     def __init__(
@@ -33,6 +109,7 @@ class DynamicOptimisationStrategy(Strategy):
         utilityFunction: Callable,
         dailyUtilityFunction: Callable,
         strategyName: str,
+        dpThreads: int = DP_THREADS,
     ):
         super().__init__(possibleInstruments)
         self.daysPerRebalance = daysPerRebalance
@@ -62,42 +139,52 @@ class DynamicOptimisationStrategy(Strategy):
             )
         ]
 
-        self.dp = {
-            period: {money: None for money in range(TOTAL_STEPS)}
-            for period in range(len(self.periodsToSim) + 1)
-        }
+        self.stockExposuresPerPeriod = [
+            [
+                {
+                    INDEX_TO_INSTRUMENT.get(instrument, instrument): exposure
+                    for instrument, exposure in distribution.portfolio.items()
+                }
+                for distribution in distributions
+            ]
+            for distributions in self.distributionsPerPeriod
+        ]
+
+        self.portfolioWeightsPerPeriod = [
+            getPortfolioWeights(distributions)
+            for distributions in self.distributionsPerPeriod
+        ]
+
+        self.packedDistributionsPerPeriod = [
+            packSignificantProbabilities(distributions)
+            for distributions in self.distributionsPerPeriod
+        ]
+
+        self.dpUtilities = np.full((len(self.periodsToSim) + 1, TOTAL_STEPS), np.nan)
+        self.dpPortfolioIndices = np.full(
+            (len(self.periodsToSim) + 1, TOTAL_STEPS), -1, dtype=np.int64
+        )
+        self.dp = np.empty((len(self.periodsToSim) + 1, TOTAL_STEPS), dtype=object)
         self.initialMoney = int(numberToLog(initialBalance))
         self.utilityFunction = utilityFunction
         self.dailyUtilityFunction = dailyUtilityFunction
         self.dailyIncome = dailyIncome
+        self.dpThreads = dpThreads
         self.incomePerPeriod = [
             sum(dailyIncome(day) for day in period) for period in self.periodsToSim
         ]
         self.optimalInitialDistribution = self.getOptimalSolution()
+        self.finalize()
 
     def getPositionsFromBasket(self, date, currentBasket) -> Basket:
         cashValue = currentBasket.getCashValue(date, adjustForDividends=True)
         logMoney = max(round(numberToLog(cashValue)), 0)
         periodIdx = self.daysToPeriodIdx[date]
 
-        finalDist, optimalPortfolio, _, _ = self.dp[periodIdx][logMoney]
-        optimalPortfolio = deepcopy(optimalPortfolio)
-
-        INDEX_TO_INSTRUMENT = {
-            "^IXIC": "QQQ",
-            "^GSPC": "SPY",
-            "^DJI": "DIA",
-            "^NYA": "VTI",
-            "^RUT": "IWM",
-            "VBMFX": "BND",
-        }
+        bestPortfolioIdx = self.dpPortfolioIndices[periodIdx, logMoney]
 
-        optimalPortfolio.portfolio = {
-            INDEX_TO_INSTRUMENT.get(instrument, instrument): exposure
-            for instrument, exposure in optimalPortfolio.portfolio.items()
-        }
         basket = getBasketFromStockExposures(
-            stockExposures=optimalPortfolio.portfolio,
+            stockExposures=self.stockExposuresPerPeriod[periodIdx][bestPortfolioIdx],
             date=date,
             basketValue=cashValue,
         )
@@ -110,68 +197,71 @@ class DynamicOptimisationStrategy(Strategy):
         maxMoney: int,
         lowerBoundDistIdx: int,
         upperBoundDistIdx: int,
+        moneyAfterIncomeLookup: np.ndarray,
     ):
-        money = (minMoney + maxMoney) // 2
         income = self.incomePerPeriod[period]
-        bestUtility = None
-        bestPortfolioIdx = 0
         retusnDistributions = self.distributionsPerPeriod[period]
         dates = self.periodsToSim[period]
-        for idxDist, dist in enumerate(retusnDistributions):
-            if idxDist < lowerBoundDistIdx or idxDist > upperBoundDistIdx:
-                continue
-            finalUtility = 0.0
-
-            for idx, probability in dist.getSignificantProbabilities():
-                moneyAfterMove = money + idx - NEGATIVE_STEPS
-                moneyAfterIncome = round(
-                    numberToLog(logToNumber(moneyAfterMove) + income)
-                )
+        significantIndices, significantProbabilities, offsets = (
+            self.packedDistributionsPerPeriod[period]
+        )
+        nextUtilities = self.dpUtilities[period + 1]
 
-                moneyAfterIncome = max(moneyAfterIncome, 0.0)
-
-                if moneyAfterIncome < 0:
-                    finalUtility += probability * self.utilityFunction(moneyAfterIncome)
-                    continue
-                else:
-                    moneyAfterIncome = min(moneyAfterIncome, TOTAL_STEPS - 1)
-                    finalUtility += probability * (
-                        self.dp[period + 1][moneyAfterIncome][0]
-                        + self.dailyUtilityFunction(
-                            x=money, y=moneyAfterIncome, date=dates[0]
-                        )
-                    )
-            if bestUtility is None or finalUtility > bestUtility:
-                bestUtility = finalUtility
-                bestPortfolio = dist
-                bestPortfolioIdx = idxDist
-
-        self.dp[period][money] = bestUtility, bestPortfolio, bestPortfolioIdx, income
-        if minMoney < money:
-            self.computeSolutionUtilityOnly(
-                period=period,
-                minMoney=minMoney,
-                maxMoney=money,
-                lowerBoundDistIdx=bestPortfolioIdx,
-                upperBoundDistIdx=upperBoundDistIdx,
+        def solveMoneyRange(moneyRange: Tuple[int, int, int, int]) -> List[Tuple]:
+            minMoney, maxMoney, lowerBoundDistIdx, upperBoundDistIdx = moneyRange
+            money = (minMoney + maxMoney) // 2
+
+            statesAfterIncome = moneyAfterIncomeLookup[money + significantIndices]
+            stateUtilities = nextUtilities.copy()
+            reachableStates = np.unique(statesAfterIncome)
+            stateUtilities[reachableStates] += self.dailyUtilityFunction(
+                x=money, y=reachableStates, date=dates[0]
             )
-        if maxMoney > money + 1:
-            self.computeSolutionUtilityOnly(
-                period=period,
-                minMoney=money + 1,
-                maxMoney=maxMoney,
-                lowerBoundDistIdx=lowerBoundDistIdx,
-                upperBoundDistIdx=bestPortfolioIdx,
+
+            bestUtility, bestPortfolioIdx = getBestDistribution(
+                statesAfterIncome,
+                stateUtilities,
+                significantProbabilities,
+                offsets,
+                lowerBoundDistIdx,
+                upperBoundDistIdx,
             )
+            bestPortfolio = retusnDistributions[bestPortfolioIdx]
+
+            self.dpUtilities[period, money] = bestUtility
+            self.dpPortfolioIndices[period, money] = bestPortfolioIdx
+            self.dp[period, money] = (bestPortfolio, bestPortfolioIdx, income)
+
+            subRanges = []
+            if minMoney < money:
+                subRanges.append((minMoney, money, bestPortfolioIdx, upperBoundDistIdx))
+            if maxMoney > money + 1:
+                subRanges.append(
+                    (money + 1, maxMoney, lowerBoundDistIdx, bestPortfolioIdx)
+                )
+            return subRanges
+
+        # Money ranges on the same level of the divide-and-conquer tree don't
+        # overlap, so each level can be solved concurrently.
+        moneyRanges = [(minMoney, maxMoney, lowerBoundDistIdx, upperBoundDistIdx)]
+        with (
+            ThreadPoolExecutor(max_workers=self.dpThreads)
+            if self.dpThreads > 1
+            else nullcontext()
+        ) as executor:
+            mapRanges = map if executor is None else executor.map
+            while moneyRanges:
+                moneyRanges = [
+                    subRange
+                    for subRanges in mapRanges(solveMoneyRange, moneyRanges)
+                    for subRange in subRanges
+                ]
 
     def getOptimalSolution(self) -> Tuple[Distribution, Distribution, int]:
+        lastPeriod = len(self.periodsToSim)
         for money in range(TOTAL_STEPS):
-            self.dp[len(self.periodsToSim)][money] = (
-                self.utilityFunction(money),
-                None,
-                None,
-                0.0,
-            )
+            self.dpUtilities[lastPeriod, money] = self.utilityFunction(money)
+            self.dp[lastPeriod, money] = (None, None, 0.0)
 
         for period in tqdm(
             range(len(self.periodsToSim) - 1, -1, -1),
@@ -184,9 +274,37 @@ class DynamicOptimisationStrategy(Strategy):
                 maxMoney=TOTAL_STEPS,
                 lowerBoundDistIdx=0,
                 upperBoundDistIdx=len(self.distributionsPerPeriod[period]) - 1,
+                moneyAfterIncomeLookup=getMoneyAfterIncomeLookup(
+                    self.incomePerPeriod[period]
+                ),
             )
 
-        return self.dp[0][self.initialMoney]
+        return (
+            self.dpUtilities[0, self.initialMoney],
+            *self.dp[0, self.initialMoney],
+        )
+
+    def finalize(self):
+        numberOfPeriods = len(self.periodsToSim)
+        portfolioIndices = self.dpPortfolioIndices[:numberOfPeriods]
+        solved = portfolioIndices >= 0
+        self.dpArrays = {
+            "utility": self.dpUtilities[:numberOfPeriods],
+            "portfolioIdx": portfolioIndices,
+            "income": np.where(
+                solved, np.reshape(self.incomePerPeriod, (-1, 1)), np.nan
+            ),
+        }
+
+        weights = np.full(
+            (numberOfPeriods, TOTAL_STEPS, len(PORTFOLIO_WEIGHT_NAMES)), np.nan
+        )
+        for period, periodWeights in enumerate(self.portfolioWeightsPerPeriod):
+            weights[period, solved[period]] = periodWeights[
+                portfolioIndices[period, solved[period]]
+            ]
+        for column, name in enumerate(PORTFOLIO_WEIGHT_NAMES):
+            self.dpArrays[name] = weights[:, :, column]
 
 
 def getDefaultStrategiesResults(
@@ -2,6 +2,7 @@ import datetime
 from functools import lru_cache
 from typing import Dict, List, Tuple
 
+import pandas as pd
 
 from dynamicPortfolioOptimisation.constants import MAX_LEVERAGE
 from dynamicPortfolioOptimisation.cpEffecientFrontier import find_efficient_frontier
@@ -11,12 +12,13 @@ from dynamicPortfolioOptimisation.distribution import (
 )
 from plots.plotUtils import getPrices
 from strategy import CASH
-from utils import getAllStockPrices
+from utils import DISK_CACHE, getAllStockPrices
 
 SPREAD = 0.015
 
 
 @lru_cache
+@DISK_CACHE.cache
 def getMeansStdsCorrelations(
     date: datetime.date,
     instrumentsToUse: Tuple[str],
@@ -24,11 +26,11 @@ def getMeansStdsCorrelations(
 ) -> Tuple[Dict[str, float], Dict[str, float], Dict[str, Dict[str, float]]]:
     interestRate = (getPrices("fedFundsRate", [date])[0] / 100 + SPREAD) / 250
 
-    prices, returns = {}, {}
+    returns = {}
 
     for instrument in instrumentsToUse:
-        prices[instrument] = getAllStockPrices(instrument).loc[:date][-1500:]
-        returns[instrument] = prices[instrument]["Close"].pct_change().dropna()
+        closes = getAllStockPrices(instrument)["Close"].loc[:date].iloc[-1500:]
+        returns[instrument] = closes.pct_change().dropna()
 
     means = {
         instrument: (1 + returns[instrument].mean() - interestRate) ** periodDays - 1
@@ -40,16 +42,9 @@ def getMeansStdsCorrelations(
         for instrument in instrumentsToUse
     }
 
-    correlations = {}
-    for instrument1 in instrumentsToUse:
-        correlations[instrument1] = {}
-        for instrument2 in instrumentsToUse:
-            commonDates = sorted(
-                set(returns[instrument1].index) & set(returns[instrument2].index)
-            )
-            returns1 = returns[instrument1].loc[commonDates]
-            returns2 = returns[instrument2].loc[commonDates]
-            correlations[instrument1][instrument2] = returns1.corr(returns2)
+    # DataFrame.corr uses pairwise complete observations, so each pair is
+    # still correlated over the dates both instruments traded on.
+    correlations = pd.concat(returns, axis=1).corr().to_dict()
 
     means[CASH] = 0.0
     stds[CASH] = 0.0
@@ -65,8 +60,21 @@ def getExpectedDistributions(
     instrumentsToUse: List[str],
     periodDays: int,
 ) -> List[Distribution]:
+    return list(
+        getCachedExpectedDistributions(
+            date, tuple(instrumentsToUse), periodDays=periodDays
+        )
+    )
+
+
+@lru_cache
+def getCachedExpectedDistributions(
+    date: datetime.date,
+    instrumentsToUse: Tuple[str],
+    periodDays: int,
+) -> Tuple[Distribution]:
     means, stds, correlations = getMeansStdsCorrelations(
-        date, tuple(instrumentsToUse), periodDays=periodDays
+        date, instrumentsToUse, periodDays=periodDays
     )
     distributions = []
 
@@ -87,4 +95,4 @@ def getExpectedDistributions(
         ), f"newDistribution: {newDistribution}"
         distributions.append(newDistribution)
 
-    return distributions
+    return tuple(distributions)
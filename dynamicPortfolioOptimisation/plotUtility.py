@@ -4,14 +4,13 @@ import numpy as np
 
 # Define the utility function
 def utility_function(W_T, W_ref, gamma):
-    return -((1 - np.minimum(np.log(W_T) / np.log(W_ref), 1)) ** gamma) + 1
+    inv_log_ref = 1.0 / np.log(W_ref)
+    return -((1 - np.minimum(np.log(W_T) * inv_log_ref, 1)) ** gamma) + 1
 
 
 def utility_function_scaled_both(W_T, W_ref, gamma, W_T_min, W_T_max):
-    # Find the minimum utility value for W_T_min
-    U_min = -((1 - min(np.log(W_T_min) / np.log(W_ref), 1)) ** gamma) + 1
-    # Find the maximum utility value for W_T_max
-    U_max = -((1 - min(np.log(W_T_max) / np.log(W_ref), 1)) ** gamma) + 1
+    # Find the minimum and maximum utility values for W_T_min and W_T_max
+    U_min, U_max = utility_function(np.array([W_T_min, W_T_max]), W_ref, gamma)
     # Calculate the scaled utility value to start all plots at the same point and end at the same point
     return (utility_function(W_T, W_ref, gamma) - U_min) / (U_max - U_min)
 
@@ -1,9 +1,11 @@
 import datetime
+from functools import lru_cache, partial
 import itertools
-from multiprocessing import Pool
+from multiprocessing import get_context
 import os
 from typing import Callable
 
+import matplotlib
 from dynamicPortfolioOptimisation.visualization import (
     visualizeAssetClassExposuresDifferentPlots,
     visualizeOptimalPortfolioLeverage,
@@ -11,14 +13,21 @@ from dynamicPortfolioOptimisation.visualization import (
     visualizeUtilityValues,
 )
 import numpy as np
+from numba import set_num_threads
 from dynamicPortfolioOptimisation.constants import LOG_BASE, TOTAL_STEPS
-from dynamicPortfolioOptimisation.distribution import logToNumber, numberToLog
+from dynamicPortfolioOptimisation.distribution import (
+    logToNumber,
+    numberToLog,
+    numberToLogArray,
+)
 from dynamicPortfolioOptimisation.dymanicOptimisationStrategy import (
+    INDEX_TO_INSTRUMENT,
     DynamicOptimisationStrategy,
     getDefaultStrategiesResults,
     getMatchingStrategyResult,
 )
 from simulation import SimulationResult, simulate
+from utils import preloadStockPrices
 
 
 os.environ["TQDM_DISABLE"] = "1"
@@ -54,12 +63,12 @@ utility_functions = {}
 
 utility_functions.update(
     {
-        "Final utility log": lambda x: x / TOTAL_STEPS if x > 0 else -1e-9,
+        "Final utility log": lambda x: np.where(x > 0, x / TOTAL_STEPS, -1e-9),
         **{
-            f"Final utility inverse log pow {i}": lambda x, i=i: (
-                -((1 - x / TOTAL_STEPS) ** i) + 1 if x > 0 else -1
+            f"Final utility inverse log pow {float(i)}": lambda x, i=i: np.where(
+                x > 0, -((1 - x / TOTAL_STEPS) ** i) + 1, -1
             )
-            for i in np.linspace(1, 15, 15)
+            for i in range(1, 16)
         },
     }
 )
@@ -70,32 +79,90 @@ inverse_utility_functions.update(
     {
         "Final utility log": lambda x: logToNumber(x * TOTAL_STEPS),
         **{
-            f"Final utility inverse log pow {i}": lambda x, i=i: logToNumber(
+            f"Final utility inverse log pow {float(i)}": lambda x, i=i: logToNumber(
                 TOTAL_STEPS * (1 - ((1 - x) ** (1 / i)))
             )
-            for i in np.linspace(1, 15, 15)
+            for i in range(1, 16)
         },
     }
 )
 
 
+LOG_OF_LOG_BASE = np.log(LOG_BASE)
+
+
+def dailyUtility(
+    x,
+    y,
+    date,
+    lossAversion: float,
+    utilityFunction: Callable,
+    finalUtilityProjectionPower: float,
+    startDate: datetime.date,
+    endDate: datetime.date,
+):
+    daysElapsed = (
+        np.asarray(date, dtype="datetime64[D]") - np.datetime64(startDate, "D")
+    ).astype(np.int64)
+    return (
+        -lossAversion * np.maximum((x - y) * LOG_OF_LOG_BASE, 0.0) ** 2
+        + utilityFunction(x)
+    ) * (daysElapsed / (endDate - startDate).days) ** finalUtilityProjectionPower
+
+
 def getPathUtility(
     result: SimulationResult, utilityFunction: Callable, dailyUtilityFunction: Callable
 ) -> float:
-    totalUtility = 0.0
-
-    for date, balance, previousBalance in zip(
-        result.balancePerDay.keys(),
-        result.balancePerDay.values(),
-        list(result.balancePerDay.values())[1:],
-    ):
-        totalUtility += dailyUtilityFunction(
-            numberToLog(balance), numberToLog(previousBalance), date
-        )
+    numberOfDays = len(result.balancePerDay)
+    logBalances = numberToLogArray(
+        np.fromiter(result.balancePerDay.values(), dtype=np.float64, count=numberOfDays)
+    )
+    dates = np.fromiter(
+        result.balancePerDay.keys(), dtype="datetime64[D]", count=numberOfDays
+    )
 
+    totalUtility = np.sum(
+        dailyUtilityFunction(logBalances[:-1], logBalances[1:], dates[:-1])
+    )
     totalUtility += utilityFunction(numberToLog(result.endBalance))
 
-    return totalUtility
+    return float(totalUtility)
+
+
+def getStrategyNames(
+    daysPerRebalance,
+    startDate,
+    endDate,
+    dailyIncomeName,
+    utilityFunctionName,
+    lossAversion,
+    finalUtilityProjectionPower,
+):
+    dailyUtilityName = (
+        f"Daily utility {-lossAversion:.6f} * "
+        f"(((date - startDate).days div (endDate - startDate).days) ** {finalUtilityProjectionPower})"
+    )
+    strategyName = f"{utilityFunctionName}/{dailyUtilityName}/{dailyIncomeName} {daysPerRebalance} days per rebalance, {startDate} to {endDate}"
+    return dailyUtilityName, strategyName
+
+
+def isSimulationDone(params) -> bool:
+    _, strategyName = getStrategyNames(*params[1:4], *params[5:])
+    return os.path.exists(f"results/optimalAssetClassExposures/{strategyName}.png")
+
+
+@lru_cache
+def makeResultDirectories(utilityFunctionName, dailyUtilityName):
+    for resultType in [
+        "optimalAssetClassExposures",
+        "optimalPortfolioLeverage",
+        "transitions",
+        "utilityValues",
+    ]:
+        os.makedirs(
+            f"results/{resultType}/{utilityFunctionName}/{dailyUtilityName}",
+            exist_ok=True,
+        )
 
 
 def run_simulation(
@@ -115,39 +182,25 @@ def run_simulation(
         inverse_utility_functions[utilityFunctionName],
     )
 
-    dailyUtilityName = (
-        f"Daily utility {-lossAversion:.6f} * "
-        f"(((date - startDate).days div (endDate - startDate).days) ** {finalUtilityProjectionPower})"
+    dailyUtilityName, strategyName = getStrategyNames(
+        daysPerRebalance,
+        startDate,
+        endDate,
+        dailyIncomeName,
+        utilityFunctionName,
+        lossAversion,
+        finalUtilityProjectionPower,
     )
-    dailyUtilityFunction = (
-        lambda x, y, date, lossAversion=lossAversion, utilityFunction=utilityFunction, finalUtilityProjectionPower=finalUtilityProjectionPower: (
-            -lossAversion * (max((x - y) * np.log(LOG_BASE), 0.0) ** 2)
-            + utilityFunction(x)
-        )
-        * ((date - startDate).days / (endDate - startDate).days)
-        ** finalUtilityProjectionPower
+    dailyUtilityFunction = partial(
+        dailyUtility,
+        lossAversion=lossAversion,
+        utilityFunction=utilityFunction,
+        finalUtilityProjectionPower=finalUtilityProjectionPower,
+        startDate=startDate,
+        endDate=endDate,
     )
 
-    strategyName = f"{utilityFunctionName}/{dailyUtilityName}/{dailyIncomeName} {daysPerRebalance} days per rebalance, {startDate} to {endDate}"
-
-    if os.path.exists(f"results/optimalAssetClassExposures/{strategyName}.png"):
-        print(f"Skipping {strategyName}")
-        return
-
-    os.makedirs(
-        f"results/optimalAssetClassExposures/{utilityFunctionName}/{dailyUtilityName}",
-        exist_ok=True,
-    )
-    os.makedirs(
-        f"results/optimalPortfolioLeverage/{utilityFunctionName}/{dailyUtilityName}",
-        exist_ok=True,
-    )
-    os.makedirs(
-        f"results/transitions/{utilityFunctionName}/{dailyUtilityName}", exist_ok=True
-    )
-    os.makedirs(
-        f"results/utilityValues/{utilityFunctionName}/{dailyUtilityName}", exist_ok=True
-    )
+    makeResultDirectories(utilityFunctionName, dailyUtilityName)
 
     strategy = DynamicOptimisationStrategy(
         possibleInstruments=possibleInstruments,
@@ -159,6 +212,8 @@ def run_simulation(
         utilityFunction=utilityFunction,
         dailyUtilityFunction=dailyUtilityFunction,
         strategyName=strategyName,
+        # Runs inside the process pool, which already uses every core.
+        dpThreads=1,
     )
     result = simulate(strategy, startDate, endDate, initialBalance, dailyIncome)
 
@@ -191,55 +246,89 @@ def run_simulation(
     visualizeAssetClassExposuresDifferentPlots(result, normalize=True)
 
 
+def run_simulation_from_params(params):
+    return run_simulation(*params)
+
+
+def init_worker():
+    matplotlib.use("Agg")
+    # The pool already runs one worker per core, so the numba kernels in each
+    # worker stay single threaded.
+    set_num_threads(1)
+
+
 if __name__ == "__main__":
     np.random.seed(0)  # For reproducibility
     initialBalance = 1e4
     daysPerRebalance = 60
     startDate = datetime.date(2005, 3, 1)
     endDate = datetime.date(2006, 3, 1)
-    possibleInstruments = ["^GSPC"]
-    possibleInstruments = ["^GSPC", "TLT", "GLD"]
+    possibleInstruments = ("^GSPC", "TLT", "GLD")
+    lastEndDate = datetime.date(2024, 1, 1)
 
-    simulation_params = []
-
-    for (
-        dailyIncomeName,
-        utilityFunctionName,
-        lossAversion,
-        finalUtilityProjectionPower,
-        datesOffset,
-        additionalDays,
-    ) in itertools.product(
-        daily_income_functions.keys(),
-        utility_functions.keys(),
-        [0] + list(np.geomspace(1e-1, 1, 3)),
-        [0],
-        list(range(0, 360 * 20, int(360 * 1))),
-        list(range(0, 360 * 0 + 1, int(360 * 1))),
-    ):
-        if endDate + datetime.timedelta(
-            days=datesOffset + additionalDays
-        ) >= datetime.date(2024, 1, 1):
-            continue
-
-        if additionalDays and datesOffset % additionalDays != 0:
-            continue
-
-        simulation_params.append(
-            (
-                possibleInstruments,
-                daysPerRebalance,
-                startDate + datetime.timedelta(days=datesOffset),
-                endDate + datetime.timedelta(days=datesOffset + additionalDays),
-                initialBalance,
-                dailyIncomeName,
-                utilityFunctionName,
-                lossAversion,
-                finalUtilityProjectionPower,
-            )
+    simulationDates = [
+        (
+            startDate + datetime.timedelta(days=datesOffset),
+            endDate + datetime.timedelta(days=datesOffset + additionalDays),
         )
+        for datesOffset, additionalDays in itertools.product(
+            range(0, 360 * 20, 360), range(0, 360 * 0 + 1, 360)
+        )
+        if endDate + datetime.timedelta(days=datesOffset + additionalDays) < lastEndDate
+        and (not additionalDays or datesOffset % additionalDays == 0)
+    ]
+
+    simulation_params = [
+        (
+            possibleInstruments,
+            daysPerRebalance,
+            simulationStartDate,
+            simulationEndDate,
+            initialBalance,
+            dailyIncomeName,
+            utilityFunctionName,
+            lossAversion,
+            finalUtilityProjectionPower,
+        )
+        for (
+            dailyIncomeName,
+            utilityFunctionName,
+            lossAversion,
+            finalUtilityProjectionPower,
+            (simulationStartDate, simulationEndDate),
+        ) in itertools.product(
+            daily_income_functions.keys(),
+            utility_functions.keys(),
+            [0] + list(np.geomspace(1e-1, 1, 3)),
+            [0],
+            simulationDates,
+        )
+    ]
+
+    simulation_params = [
+        params for params in simulation_params if not isSimulationDone(params)
+    ]
 
     print(f"Running {len(simulation_params)} simulations")
 
-    with Pool(processes=16) as pool:
-        pool.starmap(run_simulation, simulation_params)
+    # Longest simulations first so the pool does not idle on a long tail.
+    simulation_params.sort(
+        key=lambda params: (params[3] - params[2]).days, reverse=True
+    )
+
+    # Workers are forked, so they inherit the price histories loaded here
+    # instead of each downloading them again.
+    preloadStockPrices(
+        [
+            *possibleInstruments,
+            *(INDEX_TO_INSTRUMENT.get(inst, inst) for inst in possibleInstruments),
+        ]
+    )
+
+    with get_context("fork").Pool(
+        processes=16, maxtasksperchild=8, initializer=init_worker
+    ) as pool:
+        for _ in pool.imap_unordered(
+            run_simulation_from_params, simulation_params, chunksize=4
+        ):
+            pass
@@ -1,14 +1,22 @@
 import os
-from typing import Callable, List
+from functools import lru_cache
+from typing import Callable, Dict, List, Tuple
+
+import matplotlib
+
+matplotlib.use("Agg")
 
 import matplotlib.pyplot as plt
 import numpy as np
-from scipy.ndimage import zoom
+from matplotlib.ticker import FuncFormatter, MaxNLocator
+from numba import get_num_threads, njit, prange
 from tqdm import tqdm
 
 from dynamicPortfolioOptimisation.constants import (
+    LOG_BASE,
     MAX_LEVERAGE,
     MIN_VISUALIZE_STEPS,
+    MONEY_BASE,
     NEGATIVE_STEPS,
     PROBABILITY_THR,
     TOTAL_STEPS,
@@ -17,31 +25,72 @@ from dynamicPortfolioOptimisation.distribution import (
     logToNumber,
     logToNumberArray,
     numberToLog,
+    numberToLogArray,
 )
 from simulation import SimulationResult
 
 
-def interpolateMatrix(
-    arr: np.ndarray, newShapeX: int | None = None, newShapeY: int | None = None
-) -> np.ndarray:
-    newShapeX = newShapeX or arr.shape[1]
-    newShapeY = newShapeY or arr.shape[0]
-    zoom_factor_y = newShapeY / arr.shape[0]
-    zoom_factor_x = newShapeX / arr.shape[1]
-    return zoom(arr, (zoom_factor_y, zoom_factor_x), order=1)
+@lru_cache
+def getLinearInterpolationWeights(
+    oldShapeY: int, newShapeY: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    positions = np.linspace(0, oldShapeY - 1, newShapeY)
+    lowerRows = positions.astype(int)
+    upperRows = np.minimum(lowerRows + 1, oldShapeY - 1)
+    upperWeights = (positions - lowerRows).reshape(-1, 1)
+    for array in (lowerRows, upperRows, upperWeights):
+        array.flags.writeable = False
+    return lowerRows, upperRows, upperWeights
 
 
-def getAlmostZeroRange(arr: np.ndarray, thr: float = 1e-2) -> np.ndarray:
-    nonZeroRows = []
-    for i in range(arr.shape[0]):
-        if i < 2 * NEGATIVE_STEPS or not np.all(
-            np.isclose(arr[i, :], arr[i, arr.shape[1] - 1], atol=thr)
-        ):
-            nonZeroRows.append(i)
-        else:
-            break
+def interpolateMatrix(arr: np.ndarray, newShapeY: int | None = None) -> np.ndarray:
+    lowerRows, upperRows, upperWeights = getLinearInterpolationWeights(
+        arr.shape[0], newShapeY or arr.shape[0]
+    )
+    upperWeights = upperWeights.astype(arr.dtype, copy=False)
+    return arr[lowerRows] * (1 - upperWeights) + arr[upperRows] * upperWeights
 
-    return nonZeroRows
+
+def getBalanceSteps(simulationResult: SimulationResult) -> np.ndarray:
+    balances = np.fromiter(simulationResult.balancePerDay.values(), dtype=np.float64)
+    return numberToLogArray(balances).astype(int)
+
+
+FIGURE_CACHE: Dict[Tuple[float, float], plt.Figure] = {}
+
+
+def getReusableFigure(figsize: Tuple[float, float]) -> Tuple[plt.Figure, plt.Axes]:
+    fig = FIGURE_CACHE.get(figsize)
+    if fig is None:
+        fig = FIGURE_CACHE[figsize] = plt.figure(figsize=figsize)
+    fig.clf()
+    plt.figure(fig.number)
+    return fig, fig.subplots()
+
+
+def setDateTicks(ax: plt.Axes, dates: List) -> None:
+    ax.xaxis.set_major_locator(MaxNLocator(6, integer=True))
+    ax.xaxis.set_major_formatter(
+        FuncFormatter(lambda x, pos: str(dates[int(x)]) if 0 <= x < len(dates) else "")
+    )
+
+
+def setMoneyTicks(ax: plt.Axes, nbins: int) -> None:
+    ax.yaxis.set_major_locator(MaxNLocator(nbins, integer=True))
+    ax.yaxis.set_major_formatter(
+        FuncFormatter(
+            lambda y, pos: f"${logToNumber(y + MIN_VISUALIZE_STEPS) / 1e3:.1f}k"
+        )
+    )
+
+
+def getAlmostZeroRange(arr: np.ndarray, thr: float = 1e-2) -> np.ndarray:
+    almostConstantRows = np.isclose(arr, arr[:, -1:], atol=thr).all(axis=1)
+    almostConstantRows[: 2 * NEGATIVE_STEPS] = False
+    firstConstantRow = (
+        np.argmax(almostConstantRows) if almostConstantRows.any() else arr.shape[0]
+    )
+    return np.arange(firstConstantRow)
 
 
 def visualizeStateProbabilities(
@@ -52,7 +101,7 @@ def visualizeStateProbabilities(
     dates = list(simulationResult.balancePerDay.keys())
 
     plt.rcParams.update({"font.size": 22})
-    fig, ax = plt.subplots(figsize=(18, 12))
+    fig, ax = getReusableFigure((18, 12))
     arr /= np.max(arr, axis=1).reshape(-1, 1)
     arr = arr.clip(0.0, 1.0)
     arr = np.transpose(arr)
@@ -61,7 +110,7 @@ def visualizeStateProbabilities(
     arr = arr[MIN_VISUALIZE_STEPS : simulationResult.interestingRange, :]
     caxes = ax.imshow(
         arr,
-        interpolation="bicubic",
+        interpolation="nearest",
         aspect="auto",
         origin="lower",
         vmin=0,
@@ -72,20 +121,22 @@ def visualizeStateProbabilities(
         fontdict={"size": 22},
         labelpad=13,
     )
-    cumSum = np.cumsum(arr, axis=0)
-    for quantile in [0.1, 0.25, 0.5, 0.75, 0.9]:
-        quantiles = np.argmin(
-            np.where(cumSum > quantile * np.sum(arr, axis=0), cumSum, 1e18), axis=0
-        )
+    cumSum = np.cumsum(arr, axis=0, dtype=np.float32)
+    quantileLevels = np.array([0.1, 0.25, 0.5, 0.75, 0.9])
+    quantilesPerDay = np.array(
+        [
+            np.searchsorted(column, quantileLevels * column[-1], side="right")
+            for column in cumSum.T
+        ]
+    ).T
+    quantilesPerDay[quantilesPerDay == cumSum.shape[0]] = 0
+    for quantile, quantiles in zip(quantileLevels, quantilesPerDay):
         ax.plot(quantiles, color="red", linestyle="--", linewidth=1)
         ax.text(len(dates), quantiles[-1], f"p{quantile * 100:.0f}%")
 
     if simulationResult is not None:
         ax.plot(
-            [
-                int(numberToLog(amount)) - MIN_VISUALIZE_STEPS
-                for amount in simulationResult.balancePerDay.values()
-            ],
+            getBalanceSteps(simulationResult) - MIN_VISUALIZE_STEPS,
             color="Cyan",
             linestyle="--",
             linewidth=3,
@@ -95,26 +146,15 @@ def visualizeStateProbabilities(
     if strategiesToCompareAgainst is not None:
         for idx, strategy in enumerate(strategiesToCompareAgainst):
             ax.plot(
-                [
-                    int(numberToLog(amount)) - MIN_VISUALIZE_STEPS
-                    for amount in strategy.balancePerDay.values()
-                ],
+                getBalanceSteps(strategy) - MIN_VISUALIZE_STEPS,
                 linestyle="dashdot",
                 linewidth=2,
                 label=strategy.strategyName,
             )
 
-    ax.set_xticks(range(len(dates)), dates, rotation=0)
+    setDateTicks(ax, dates)
     ax.xaxis.set_ticks_position("bottom")
-    money = list(
-        map(
-            lambda x: f"${logToNumber(x) / 1e3:.1f}k".format(x),
-            list(range(MIN_VISUALIZE_STEPS, MIN_VISUALIZE_STEPS + arr.shape[0])),
-        )
-    )
-    ax.set_yticks(range(len(money)), money)
-    ax.locator_params(axis="y", nbins=12)
-    ax.locator_params(axis="x", nbins=6)
+    setMoneyTicks(ax, nbins=12)
     ax.tick_params(axis="both", which="major", pad=15)
     ax.set_xlabel("Date", fontdict={"size": 22}, labelpad=13)
     ax.set_ylabel("Net Worth", fontdict={"size": 22}, labelpad=0)
@@ -145,49 +185,88 @@ def visualizeStateProbabilities(
     )
 
 
-def calculateStateProbabilitiesMatrix(
-    simulationResult: SimulationResult,
+@njit(parallel=True, cache=True)
+def propagateStateProbabilities(
+    priors: np.ndarray,
+    portfolioIndices: np.ndarray,
+    significantIndices: np.ndarray,
+    significantProbabilities: np.ndarray,
+    offsets: np.ndarray,
+    income: float,
 ) -> np.ndarray:
-    dp = simulationResult.strategy.dp
-    numberOfDays = len(simulationResult.strategy.periodsToSim)
-    transitionProbabilities = np.zeros((numberOfDays + 1, TOTAL_STEPS))
-    transitionProbabilities[0, int(numberToLog(simulationResult.initialBalance))] = 1.0
-
-    for day in tqdm(range(numberOfDays), desc="Calculating transition probabilities"):
-        for money in range(TOTAL_STEPS):
-            if dp[day][money] is None:
-                continue
-
-            if transitionProbabilities[day, money] < PROBABILITY_THR:
+    # Only a narrow band of money states carries probability on any given day,
+    # so the chunks are spread over that band rather than over all states.
+    lowMoney, highMoney = TOTAL_STEPS, 0
+    for money in range(TOTAL_STEPS):
+        if portfolioIndices[money] >= 0 and priors[money] >= PROBABILITY_THR:
+            lowMoney = min(lowMoney, money)
+            highMoney = money + 1
+
+    # Every chunk of money states scatters into its own row, so the parallel
+    # chunks never write to the same buffer.
+    numberOfChunks = get_num_threads()
+    chunkSize = (max(highMoney - lowMoney, 0) + numberOfChunks - 1) // numberOfChunks
+    partialProbabilities = np.zeros((numberOfChunks, TOTAL_STEPS))
+
+    for chunk in prange(numberOfChunks):
+        for money in range(
+            lowMoney + chunk * chunkSize,
+            min(lowMoney + (chunk + 1) * chunkSize, highMoney),
+        ):
+            portfolioIdx = portfolioIndices[money]
+            if portfolioIdx < 0 or priors[money] < PROBABILITY_THR:
                 continue
 
-            _, distribution, idx, income = dp[day][money]
-
-            for idx, prob in distribution.getSignificantProbabilities():
-                if prob * transitionProbabilities[day, money] < 1e-10:
+            for k in range(offsets[portfolioIdx], offsets[portfolioIdx + 1]):
+                prob = significantProbabilities[k] * priors[money]
+                if prob < 1e-10:
                     continue
 
-                afterIncome = numberToLog(
-                    logToNumber(idx + money - NEGATIVE_STEPS) + income
+                moneyAfterMove = significantIndices[k] + money - NEGATIVE_STEPS
+                valueAfterIncome = (
+                    LOG_BASE ** (moneyAfterMove - NEGATIVE_STEPS) * MONEY_BASE + income
+                )
+                # The log is NaN here and would pass the range check below.
+                if not valueAfterIncome > 0:
+                    continue
+                afterIncome = (
+                    np.log(valueAfterIncome / MONEY_BASE) / np.log(LOG_BASE)
+                    + NEGATIVE_STEPS
                 )
                 if afterIncome < 0 or afterIncome >= TOTAL_STEPS - 2:
                     continue
 
-                upProb = (
-                    prob
-                    * (afterIncome - int(afterIncome))
-                    * transitionProbabilities[day, money]
-                )
-                downProb = (
-                    prob
-                    * (1 - (afterIncome - int(afterIncome)))
-                    * transitionProbabilities[day, money]
-                )
-                transitionProbabilities[day + 1, int(afterIncome) + 1] += upProb
-                transitionProbabilities[day + 1, int(afterIncome)] += downProb
+                lower = int(afterIncome)
+                upFraction = afterIncome - lower
+                partialProbabilities[chunk, lower + 1] += prob * upFraction
+                partialProbabilities[chunk, lower] += prob * (1 - upFraction)
+
+    return partialProbabilities.sum(axis=0)
+
+
+def calculateStateProbabilitiesMatrix(
+    simulationResult: SimulationResult,
+) -> np.ndarray:
+    strategy = simulationResult.strategy
+    numberOfDays = len(strategy.periodsToSim)
+    transitionProbabilities = np.zeros((numberOfDays + 1, TOTAL_STEPS))
+    transitionProbabilities[0, int(numberToLog(simulationResult.initialBalance))] = 1.0
+
+    for day in tqdm(
+        range(numberOfDays),
+        desc="Calculating transition probabilities",
+        mininterval=0.5,
+        miniters=max(1, numberOfDays // 200),
+    ):
+        transitionProbabilities[day + 1] = propagateStateProbabilities(
+            transitionProbabilities[day],
+            strategy.dpArrays["portfolioIdx"][day],
+            *strategy.packedDistributionsPerPeriod[day],
+            strategy.incomePerPeriod[day],
+        )
 
     transitionProbabilities = interpolateMatrix(
-        transitionProbabilities,
+        transitionProbabilities.astype(np.float32),
         newShapeY=simulationResult.strategy.daysPerRebalance
         * transitionProbabilities.shape[0],
     )[: len(simulationResult.balancePerDay), :]
@@ -195,23 +274,27 @@ def calculateStateProbabilitiesMatrix(
     return transitionProbabilities
 
 
-def calculateUtilityValuesMatrix(simulationResult: SimulationResult) -> np.ndarray:
-    dp = simulationResult.strategy.dp
-    numberOfDays = len(simulationResult.strategy.periodsToSim)
-    utilityValuesMatrix = np.zeros((numberOfDays, TOTAL_STEPS))
-    for day in tqdm(range(numberOfDays), desc="Calculating utility values"):
-        for money in range(TOTAL_STEPS):
-            if dp[day][money] is None:
-                continue
-            utilityValuesMatrix[day, money] = dp[day][money][0]
+def calculateDpMatrices(simulationResult: SimulationResult) -> Dict[str, np.ndarray]:
+    if simulationResult.dpMatrices is not None:
+        return simulationResult.dpMatrices
 
-    utilityValuesMatrix = interpolateMatrix(
-        utilityValuesMatrix,
-        newShapeY=simulationResult.strategy.daysPerRebalance
-        * utilityValuesMatrix.shape[0],
-    )[: len(simulationResult.balancePerDay), :]
+    strategy = simulationResult.strategy
+    matrices = {
+        name: np.nan_to_num(strategy.dpArrays[name], nan=0.0).astype(np.float32)
+        for name in ["utility", "leverage", "equity", "bond", "gold"]
+    }
 
-    return utilityValuesMatrix
+    simulationResult.dpMatrices = {
+        name: interpolateMatrix(
+            matrix, newShapeY=strategy.daysPerRebalance * matrix.shape[0]
+        )[: len(simulationResult.balancePerDay), :]
+        for name, matrix in matrices.items()
+    }
+    return simulationResult.dpMatrices
+
+
+def calculateUtilityValuesMatrix(simulationResult: SimulationResult) -> np.ndarray:
+    return calculateDpMatrices(simulationResult)["utility"].copy()
 
 
 def visualizeUtilityValues(
@@ -231,10 +314,10 @@ def visualizeUtilityValues(
     dates = list(simulationResult.balancePerDay.keys())
 
     plt.rcParams.update({"font.size": 22})
-    fig, ax = plt.subplots(figsize=(18, 12))
+    fig, ax = getReusableFigure((18, 12))
     caxes = ax.matshow(
         utilityValuesMatrix,
-        interpolation="bicubic",
+        interpolation="nearest",
         aspect="auto",
         origin="lower",
         cmap="cool" if inverseUtilityFunction is None else "spring",
@@ -248,24 +331,11 @@ def visualizeUtilityValues(
         fontdict={"size": 22},
         labelpad=13,
     )
-    ax.set_xticks(range(len(dates)), dates, rotation=0)
+    setDateTicks(ax, dates)
     ax.xaxis.set_ticks_position("bottom")
-    money = list(
-        map(
-            lambda x: f"${logToNumber(x) / 1e3:.1f}k".format(x),
-            list(
-                range(
-                    MIN_VISUALIZE_STEPS,
-                    MIN_VISUALIZE_STEPS + utilityValuesMatrix.shape[0],
-                )
-            ),
-        )
-    )
-    ax.set_yticks(range(len(money)), money)
+    setMoneyTicks(ax, nbins=12)
     ax.set_xlabel("Date", fontdict={"size": 22}, labelpad=13)
     ax.set_ylabel("Net Worth", fontdict={"size": 22}, labelpad=0)
-    ax.locator_params(axis="y", nbins=12)
-    ax.locator_params(axis="x", nbins=6)
     ax.tick_params(axis="both", which="major", pad=15)
     plt.grid(True)
     fig.tight_layout()
@@ -278,24 +348,7 @@ def visualizeUtilityValues(
 def calculateOptimalPortfolioLeverageMatrix(
     simulationResult: SimulationResult,
 ) -> np.ndarray:
-    dp = simulationResult.strategy.dp
-    numberOfDays = len(simulationResult.strategy.periodsToSim)
-    optimalPortfolioLeverageMatrix = np.zeros((numberOfDays, TOTAL_STEPS))
-    for day in tqdm(range(numberOfDays), desc="Calculating optimal portfolio leverage"):
-        for money in range(TOTAL_STEPS):
-            if dp[day][money] is None:
-                continue
-            utility, bestPortfolio, idx, income = dp[day][money]
-            optimalPortfolioLeverageMatrix[day, money] = sum(
-                bestPortfolio.portfolio.values()
-            )
-
-    optimalPortfolioLeverageMatrix = interpolateMatrix(
-        optimalPortfolioLeverageMatrix,
-        newShapeY=simulationResult.strategy.daysPerRebalance
-        * optimalPortfolioLeverageMatrix.shape[0],
-    )[: len(simulationResult.balancePerDay), :]
-    return optimalPortfolioLeverageMatrix
+    return calculateDpMatrices(simulationResult)["leverage"].copy()
 
 
 def visualizeOptimalPortfolioLeverage(simulationResult: SimulationResult):
@@ -308,10 +361,10 @@ def visualizeOptimalPortfolioLeverage(simulationResult: SimulationResult):
     dates = list(simulationResult.balancePerDay.keys())
 
     plt.rcParams.update({"font.size": 22})
-    fig, ax = plt.subplots(figsize=(18, 12))
+    fig, ax = getReusableFigure((18, 12))
     caxes = ax.matshow(
         optimalPortfolioLeverageMatrix,
-        interpolation="bicubic",
+        interpolation="nearest",
         aspect="auto",
         origin="lower",
         vmin=0,
@@ -320,24 +373,11 @@ def visualizeOptimalPortfolioLeverage(simulationResult: SimulationResult):
     )
     fig.colorbar(caxes, location="top", format="%.2f", pad=0.05)
 
-    ax.set_xticks(range(len(dates)), dates, rotation=0)
+    setDateTicks(ax, dates)
     ax.xaxis.set_ticks_position("bottom")
     ax.set_xlabel("Date", fontdict={"size": 22}, labelpad=13)
     ax.set_ylabel("Net Worth", fontdict={"size": 22}, labelpad=0)
-    money = list(
-        map(
-            lambda x: f"${logToNumber(x) / 1e3:.1f}k".format(x),
-            list(
-                range(
-                    MIN_VISUALIZE_STEPS,
-                    MIN_VISUALIZE_STEPS + optimalPortfolioLeverageMatrix.shape[0],
-                )
-            ),
-        )
-    )
-    ax.set_yticks(range(len(money)), money)
-    ax.locator_params(axis="y", nbins=12)
-    ax.locator_params(axis="x", nbins=6)
+    setMoneyTicks(ax, nbins=12)
     ax.tick_params(axis="both", which="major", pad=15)
     plt.title("Optimal portfolio leverage over time")
     plt.grid(True)
@@ -416,6 +456,7 @@ def visualizeAssetClassExposures(simulationResult: SimulationResult):
     plt.savefig(
         f"results/optimalAssetClassExposures/{simulationResult.strategy.strategyName}.png"
     )
+    plt.close(fig)
 
 
 def visualizeAssetClassExposuresDifferentPlots(
@@ -472,7 +513,7 @@ def visualizeAssetClassExposuresDifferentPlots(
     for i, (matrix, title) in enumerate(plots):
         caxes = ax[i].matshow(
             matrix,
-            interpolation="bicubic",
+            interpolation="nearest",
             aspect="auto",
             origin="lower",
             vmin=0.0,
@@ -480,25 +521,12 @@ def visualizeAssetClassExposuresDifferentPlots(
             cmap="rainbow" if not normalize or i == 0 else "viridis",
         )
         fig.colorbar(caxes, ax=ax[i], location="right", format="%.2f", pad=0.01)
-        ax[i].set_xticks(range(len(dates)), dates, rotation=0)
+        setDateTicks(ax[i], dates)
         ax[i].xaxis.set_ticks_position("bottom")
         if i == len(plots) - 1:
             ax[i].set_xlabel("Date", fontdict={"size": 22}, labelpad=13)
         ax[i].set_ylabel("Net Worth", fontdict={"size": 22}, labelpad=0)
-        money = list(
-            map(
-                lambda x: f"${logToNumber(x) / 1e3:.1f}k".format(x),
-                list(
-                    range(
-                        MIN_VISUALIZE_STEPS,
-                        MIN_VISUALIZE_STEPS + matrix.shape[0],
-                    )
-                ),
-            )
-        )
-        ax[i].set_yticks(range(len(money)), money)
-        ax[i].locator_params(axis="y", nbins=7)
-        ax[i].locator_params(axis="x", nbins=6)
+        setMoneyTicks(ax[i], nbins=7)
         ax[i].tick_params(axis="both", which="major", pad=15)
         ax[i].set_title(title, fontdict={"size": 22}, pad=13)
 
@@ -508,48 +536,15 @@ def visualizeAssetClassExposuresDifferentPlots(
     plt.savefig(
         f"results/optimalAssetClassExposures/{simulationResult.strategy.strategyName}_{normalize}.png"
     )
+    plt.close(fig)
 
 
 def calculateAssetClassExposures(
     simulationResult: SimulationResult,
 ) -> np.ndarray:
-    dp = simulationResult.strategy.dp
-    numberOfDays = len(simulationResult.strategy.periodsToSim)
-    optimalEquityExposureMatrix = np.zeros((numberOfDays, TOTAL_STEPS))
-    optimalBondExposureMatrix = np.zeros((numberOfDays, TOTAL_STEPS))
-    optimalGoldExposureMatrix = np.zeros((numberOfDays, TOTAL_STEPS))
-    for day in tqdm(range(numberOfDays), desc="Calculating optimal portfolio leverage"):
-        for money in range(TOTAL_STEPS):
-            if dp[day][money] is None:
-                continue
-            _, bestPortfolio, _, _ = dp[day][money]
-            optimalEquityExposureMatrix[day, money] = bestPortfolio.portfolio.get(
-                "^GSPC", 0.0
-            )
-            optimalBondExposureMatrix[day, money] = bestPortfolio.portfolio.get(
-                "TLT", 0.0
-            )
-            optimalGoldExposureMatrix[day, money] = bestPortfolio.portfolio.get(
-                "GLD", 0.0
-            )
-
-    optimalEquityExposureMatrix = interpolateMatrix(
-        optimalEquityExposureMatrix,
-        newShapeY=simulationResult.strategy.daysPerRebalance
-        * optimalEquityExposureMatrix.shape[0],
-    )[: len(simulationResult.balancePerDay), :]
-    optimalBondExposureMatrix = interpolateMatrix(
-        optimalBondExposureMatrix,
-        newShapeY=simulationResult.strategy.daysPerRebalance
-        * optimalBondExposureMatrix.shape[0],
-    )[: len(simulationResult.balancePerDay), :]
-    optimalGoldExposureMatrix = interpolateMatrix(
-        optimalGoldExposureMatrix,
-        newShapeY=simulationResult.strategy.daysPerRebalance
-        * optimalGoldExposureMatrix.shape[0],
-    )[: len(simulationResult.balancePerDay), :]
+    dpMatrices = calculateDpMatrices(simulationResult)
     return (
-        optimalEquityExposureMatrix,
-        optimalBondExposureMatrix,
-        optimalGoldExposureMatrix,
+        dpMatrices["equity"].copy(),
+        dpMatrices["bond"].copy(),
+        dpMatrices["gold"].copy(),
     )
@@ -2,9 +2,17 @@ import os
 from datetime import datetime, timedelta
 
 import matplotlib.pyplot as plt
+import numpy as np
 import pandas as pd
 
-from plots.plotUtils import REAL_NAMES, STOCKS, getCommonDates, getPrices
+from plots.plotUtils import (
+    REAL_NAMES,
+    STOCKS,
+    getCommonDates,
+    getPrices,
+    rollingCorrelations,
+    runPlotJobs,
+)
 from utils import LOCAL_PATH
 
 COLORMAP = {
@@ -35,15 +43,14 @@ def buildCorrelationPlotsInTime(
     df = pd.DataFrame(data, index=tradingDays)
     df_returns = df.pct_change().dropna()
 
-    corr10 = (
-        df_returns[stockToCompare].rolling(10).corr(df_returns[stockCompareAgainst])
-    ).dropna()
-    corr50 = (
-        df_returns[stockToCompare].rolling(50).corr(df_returns[stockCompareAgainst])
-    ).dropna()
-    corr250 = (
-        df_returns[stockToCompare].rolling(250).corr(df_returns[stockCompareAgainst])
-    ).dropna()
+    returns = df_returns[stockToCompare].to_numpy(dtype=np.float64)
+    returnsAgainst = df_returns[stockCompareAgainst].to_numpy(dtype=np.float64)
+    corr10, corr50, corr250 = (
+        pd.Series(correlations, index=df_returns.index).dropna()
+        for correlations in rollingCorrelations(
+            returns, returnsAgainst, np.array([10, 50, 250])
+        )
+    )
 
     correlation = df_returns.corr()
 
@@ -80,6 +87,7 @@ def buildCorrelationPlotsInTime(
             f"correlation_in_time_{name}_{stockToCompare}",
         )
     )
+    plt.close(fig)
 
     print(f"Correlation coefficient:\n{correlation}")
 
@@ -88,10 +96,14 @@ def run():
     stockToCompare = "^GSPC"
     startDate = datetime.now().date() + timedelta(days=-300000)
     endDate = datetime.now().date() + timedelta(days=-3)
-    for stockCompareAgainst in STOCKS + ["vixIndex"]:
-        buildCorrelationPlotsInTime(
-            stockToCompare=stockToCompare,
-            stockCompareAgainst=stockCompareAgainst,
-            startDate=startDate,
-            endDate=endDate,
-        )
+    jobs = [
+        (stockToCompare, stockCompareAgainst, startDate, endDate)
+        for stockCompareAgainst in STOCKS + ["vixIndex"]
+    ]
+    runPlotJobs(
+        buildCorrelationPlotsInTime,
+        jobs,
+        STOCKS + ["vixIndex"],
+        startDate,
+        endDate,
+    )
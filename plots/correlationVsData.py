@@ -2,16 +2,16 @@ import os
 from datetime import datetime, timedelta
 
 import matplotlib.pyplot as plt
-import pandas as pd
 
 from plots.plotUtils import (
     REAL_NAMES,
     STOCKS,
     TOLERANCE,
     USE_RETURNS,
-    getCommonDates,
-    getPrices,
+    getAlignedPrices,
+    getFilterWindows,
     pearsonr_ci,
+    runPlotJobs,
 )
 from utils import LOCAL_PATH
 
@@ -24,17 +24,16 @@ def buildCorrelationVsDataPlots(
     endDate,
     cumulative=False,
 ):
-    tradingDays = getCommonDates(
-        startDate, endDate, [stockToCompare, stockCompareAgainst, dataToFilter]
+    df = getAlignedPrices(
+        {
+            stockToCompare: stockToCompare,
+            stockCompareAgainst: stockCompareAgainst,
+            f"filter_{dataToFilter}": dataToFilter,
+        },
+        startDate,
+        endDate,
     )
-
-    data = {
-        stockToCompare: getPrices(stockToCompare, tradingDays),
-        stockCompareAgainst: getPrices(stockCompareAgainst, tradingDays),
-        f"filter_{dataToFilter}": getPrices(dataToFilter, tradingDays),
-    }
-
-    df = pd.DataFrame(data, index=tradingDays)
+    tradingDays = df.index
     if dataToFilter in USE_RETURNS:
         df = df.pct_change()
     else:
@@ -44,20 +43,13 @@ def buildCorrelationVsDataPlots(
 
     df = df.dropna()
 
-    dataToFilterValues = sorted(set(sorted(df[f"filter_{dataToFilter}"])))
     x, correlations, dest = [], [], []
     correlationsLow, correlationsHigh = [], []
 
-    for value in dataToFilterValues:
-        df1 = df[
-            ((value - TOLERANCE[dataToFilter]) <= df[f"filter_{dataToFilter}"])
-            & (df[f"filter_{dataToFilter}"] <= value)
-        ]
-
+    for df1 in getFilterWindows(df, f"filter_{dataToFilter}", TOLERANCE[dataToFilter]):
         if (len(df1) < 100) or (len(x) == 0 and len(df1) < 1000):
             continue
 
-        correlation = df1[[stockToCompare, stockCompareAgainst]].corr().iloc[0, 1]
         correlation, low, high = pearsonr_ci(
             x=df1[stockCompareAgainst], y=df1[stockToCompare]
         )
@@ -123,28 +115,33 @@ def buildCorrelationVsDataPlots(
             f"correlation_vs_value_{stockToCompare}_{stockCompareAgainst}_{dataToFilter}",
         )
     )
+    plt.close(fig)
 
 
 def run():
     stockToCompare = "^GSPC"
     startDate = datetime.now().date() + timedelta(days=-300000)
     endDate = datetime.now().date() + timedelta(days=-3)
-    for dataToFilter in [
+    dataToFilterNames = [
         "^GSPC",
         "fedFundsRate",
         "cpiTotal",
         "coreInflationUS",
         "vixIndex",
-    ]:
-        for stockCompareAgainst in STOCKS + ["vixIndex"]:
-            if stockCompareAgainst != stockToCompare:
-                buildCorrelationVsDataPlots(
-                    stockToCompare=stockToCompare,
-                    stockCompareAgainst=stockCompareAgainst,
-                    dataToFilter=dataToFilter,
-                    startDate=startDate,
-                    endDate=endDate,
-                )
+    ]
+    jobs = [
+        (stockToCompare, stockCompareAgainst, dataToFilter, startDate, endDate)
+        for dataToFilter in dataToFilterNames
+        for stockCompareAgainst in STOCKS + ["vixIndex"]
+        if stockCompareAgainst != stockToCompare
+    ]
+    runPlotJobs(
+        buildCorrelationVsDataPlots,
+        jobs,
+        STOCKS + dataToFilterNames,
+        startDate,
+        endDate,
+    )
 
 
 run()
@@ -1,19 +1,82 @@
-from typing import List
+from functools import cache
+from multiprocessing import get_context
+from typing import Callable, Dict, List, Tuple
 
-from scipy import stats
+import matplotlib
+import numpy as np
+import pandas as pd
+from numba import njit
+from scipy.special import ndtri
 
 from utils import (
     getEconomicDataDates,
-    getEconomicDataForDate,
-    getStockPriceForDate,
+    getEconomicDataForDates,
+    getStockPricesForDates,
     getStockTradingDays,
+    intersectTradingDays,
 )
 
 
 def pearsonr_ci(x, y, confidenceLevel=0.99):
-    result = stats.pearsonr(x, y)
-    low, high = result.confidence_interval(confidence_level=confidenceLevel)
-    return result.correlation, low, high
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    xCentered, yCentered = x - x.mean(), y - y.mean()
+    correlation = np.clip(
+        (xCentered @ yCentered)
+        / np.sqrt((xCentered @ xCentered) * (yCentered @ yCentered)),
+        -1.0,
+        1.0,
+    )
+    # Fisher transform, as in scipy's PearsonRResult.confidence_interval.
+    halfWidth = ndtri(0.5 + confidenceLevel / 2) / np.sqrt(len(x) - 3)
+    low, high = np.tanh(np.arctanh(correlation) + np.array([-halfWidth, halfWidth]))
+    return float(correlation), float(low), float(high)
+
+
+@njit(cache=True)
+def rollingCorrelations(
+    x: np.ndarray, y: np.ndarray, windows: np.ndarray
+) -> np.ndarray:
+    # Running sums are updated by one element in and one out per step, so the
+    # cost does not depend on the window lengths, and all windows share a
+    # single pass over the data.
+    correlations = np.full((windows.shape[0], x.shape[0]), np.nan)
+    sumX = np.zeros(windows.shape[0])
+    sumY = np.zeros(windows.shape[0])
+    sumXX = np.zeros(windows.shape[0])
+    sumYY = np.zeros(windows.shape[0])
+    sumXY = np.zeros(windows.shape[0])
+    # Running sums leave rounding residue behind, so a window of equal values
+    # is detected from the length of the current run instead, as pandas does.
+    runX, runY = 0, 0
+    for i in range(x.shape[0]):
+        runX = runX + 1 if i > 0 and x[i] == x[i - 1] else 1
+        runY = runY + 1 if i > 0 and y[i] == y[i - 1] else 1
+        for w in range(windows.shape[0]):
+            window = windows[w]
+            sumX[w] += x[i]
+            sumY[w] += y[i]
+            sumXX[w] += x[i] * x[i]
+            sumYY[w] += y[i] * y[i]
+            sumXY[w] += x[i] * y[i]
+            if i >= window:
+                j = i - window
+                sumX[w] -= x[j]
+                sumY[w] -= y[j]
+                sumXX[w] -= x[j] * x[j]
+                sumYY[w] -= y[j] * y[j]
+                sumXY[w] -= x[j] * y[j]
+            if i < window - 1 or runX >= window or runY >= window:
+                continue
+
+            meanX, meanY = sumX[w] / window, sumY[w] / window
+            varianceX = sumXX[w] / window - meanX * meanX
+            varianceY = sumYY[w] / window - meanY * meanY
+            if varianceX > 0 and varianceY > 0:
+                correlations[w, i] = (sumXY[w] / window - meanX * meanY) / np.sqrt(
+                    varianceX * varianceY
+                )
+
+    return correlations
 
 
 REAL_NAMES = {
@@ -67,22 +130,60 @@ def getCommonDates(startDate, endDate, instruments):
         else:
             raise ValueError(f"Invalid instrument: {inst}")
 
-    return [
-        day
-        for day in tradingDays[0]
-        if all(day in tradingDays[i] for i in range(1, len(tradingDays)))
-    ]
+    return intersectTradingDays(tradingDays)
+
 
+def getFilterWindows(df: pd.DataFrame, filterColumn: str, tolerance: float):
+    # Yields, for every distinct filter value, the rows whose filter value lies
+    # in [value - tolerance, value], as a contiguous slice of the sorted frame.
+    df = df.sort_values(filterColumn, kind="stable")
+    filterValues = df[filterColumn].to_numpy()
+    # Already sorted, so the distinct values are the first of each run.
+    values = filterValues[np.r_[True, filterValues[1:] != filterValues[:-1]]]
+    starts = np.searchsorted(filterValues, values - tolerance, side="left")
+    ends = np.searchsorted(filterValues, values, side="right")
+    for start, end in zip(starts, ends):
+        yield df.iloc[start:end]
 
-def getPrices(instrumentName, dates) -> List[float]:
+
+def getPrices(instrumentName, dates) -> np.ndarray:
     if instrumentName in STOCKS:
-        prices = [getStockPriceForDate(instrumentName, date) for date in dates]
+        prices = getStockPricesForDates(instrumentName, dates)
     elif instrumentName in ECONOMIC_DATA:
-        prices = [
-            getEconomicDataForDate(date=date, filename=f"{instrumentName}.csv")
-            for date in dates
-        ]
+        prices = getEconomicDataForDates(dates, filename=f"{instrumentName}.csv")
     else:
         raise ValueError(f"Invalid instrument: {instrumentName}")
 
     return prices
+
+
+@cache
+def getPriceSeries(instrumentName, startDate, endDate) -> pd.Series:
+    dates = getCommonDates(startDate, endDate, [instrumentName])
+    return pd.Series(getPrices(instrumentName, dates), index=dates)
+
+
+def getAlignedPrices(columns: Dict[str, str], startDate, endDate) -> pd.DataFrame:
+    # Maps column name -> instrument and keeps only the dates all of them share.
+    return pd.concat(
+        {
+            column: getPriceSeries(instrumentName, startDate, endDate)
+            for column, instrumentName in columns.items()
+        },
+        axis=1,
+        join="inner",
+    )
+
+
+def runPlotJobs(
+    buildPlot: Callable, jobs: List[Tuple], instruments: List[str], startDate, endDate
+):
+    # Workers are forked, so they inherit the price histories loaded here
+    # instead of each downloading them again.
+    for instrumentName in instruments:
+        getPriceSeries(instrumentName, startDate, endDate)
+
+    with get_context("fork").Pool(
+        initializer=matplotlib.use, initargs=("Agg",)
+    ) as pool:
+        pool.starmap(buildPlot, jobs)
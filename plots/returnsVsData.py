@@ -3,7 +3,6 @@ from datetime import datetime, timedelta
 
 import matplotlib.pyplot as plt
 import numpy as np
-import pandas as pd
 from scipy.stats import gmean, gstd
 
 from plots.plotUtils import (
@@ -11,8 +10,9 @@ from plots.plotUtils import (
     STOCKS,
     TOLERANCE,
     USE_RETURNS,
-    getCommonDates,
-    getPrices,
+    getAlignedPrices,
+    getFilterWindows,
+    runPlotJobs,
 )
 from utils import LOCAL_PATH
 
@@ -23,14 +23,12 @@ def buildReturnsVsDataPlots(
     startDate,
     endDate,
 ):
-    tradingDays = getCommonDates(startDate, endDate, [stockToCompare, dataToFilter])
-
-    data = {
-        stockToCompare: getPrices(stockToCompare, tradingDays),
-        f"filter_{dataToFilter}": getPrices(dataToFilter, tradingDays),
-    }
-
-    df = pd.DataFrame(data, index=tradingDays)
+    df = getAlignedPrices(
+        {stockToCompare: stockToCompare, f"filter_{dataToFilter}": dataToFilter},
+        startDate,
+        endDate,
+    )
+    tradingDays = df.index
 
     if dataToFilter in USE_RETURNS:
         df = df.pct_change()
@@ -39,16 +37,10 @@ def buildReturnsVsDataPlots(
 
     df = df.dropna()
 
-    dataToFilterValues = sorted(set(sorted(df[f"filter_{dataToFilter}"])))
     x, ansMean, ansMedian, dest = [], [], [], []
     ansPlusStd, ansMinusStd = [], []
 
-    for value in dataToFilterValues:
-        df1 = df[
-            ((value - TOLERANCE[dataToFilter]) <= df[f"filter_{dataToFilter}"])
-            & (df[f"filter_{dataToFilter}"] <= value)
-        ]
-
+    for df1 in getFilterWindows(df, f"filter_{dataToFilter}", TOLERANCE[dataToFilter]):
         if (len(df1) < 100) or (len(x) == 0 and len(df1) < 1000):
             continue
 
@@ -102,24 +94,26 @@ def buildReturnsVsDataPlots(
             f"returns_vs_data_{stockToCompare}_{dataToFilter}",
         )
     )
+    plt.close(fig)
 
 
 def run():
     startDate = datetime.now().date() + timedelta(days=-300000)
     endDate = datetime.now().date() + timedelta(days=-3)
 
-    for dataToFilter in [
+    dataToFilterNames = [
         "fedFundsRate",
         "coreInflationUS",
         "vixIndex",
-    ]:
-        for stock in STOCKS + ["vixIndex"]:
-            buildReturnsVsDataPlots(
-                stockToCompare=stock,
-                dataToFilter=dataToFilter,
-                startDate=startDate,
-                endDate=endDate,
-            )
+    ]
+    jobs = [
+        (stock, dataToFilter, startDate, endDate)
+        for dataToFilter in dataToFilterNames
+        for stock in STOCKS + ["vixIndex"]
+    ]
+    runPlotJobs(
+        buildReturnsVsDataPlots, jobs, STOCKS + dataToFilterNames, startDate, endDate
+    )
 
 
 if __name__ == "__main__":
@@ -1,14 +1,27 @@
 import dataclasses
 import datetime
+from functools import cached_property
 from math import pow
 from typing import Callable, Dict, List, Tuple
 
+import numpy as np
+from numba import njit
 from tqdm import tqdm
 
 from dynamicPortfolioOptimisation.expectedDistributions import SPREAD
 from plots.plotUtils import getPrices
-from strategy import Basket, Strategy
-from utils import getStockTradingDays
+from strategy import (
+    Basket,
+    ConstantExposuresStrategy,
+    Strategy,
+    getInstrumentTypeMask,
+)
+from utils import (
+    getDividendsForDates,
+    getStockPricesForDates,
+    getStockTradingDays,
+    intersectTradingDays,
+)
 
 
 @dataclasses.dataclass
@@ -21,6 +34,10 @@ class SimulationResult:
     basketsPerDay: Dict[datetime.date, Basket]
     contributionsPerDay: Dict[datetime.date, float]
     strategy: Strategy | None = None
+    # Interpolated DP matrices, filled in by visualization.calculateDpMatrices.
+    dpMatrices: Dict[str, np.ndarray] | None = dataclasses.field(
+        default=None, init=False, repr=False, compare=False
+    )
 
     def getCARG(self) -> float:
         return (
@@ -31,49 +48,51 @@ class SimulationResult:
             - 1
         ) * 100
 
+    @cached_property
+    def dates(self) -> List[datetime.date]:
+        return list(self.balancePerDay)
+
+    @cached_property
+    def dailyBalances(self) -> np.ndarray:
+        return np.fromiter(
+            self.balancePerDay.values(), dtype=np.float64, count=len(self.balancePerDay)
+        )
+
+    @cached_property
+    def dailyReturns(self) -> np.ndarray:
+        return np.diff(self.dailyBalances) / self.dailyBalances[:-1]
+
+    @cached_property
+    def dailyReturnsWithoutContributions(self) -> np.ndarray:
+        contributions = np.fromiter(
+            (self.contributionsPerDay[date] for date in self.dates[1:]),
+            dtype=np.float64,
+            count=len(self.balancePerDay) - 1,
+        )
+        return (np.diff(self.dailyBalances) - contributions) / self.dailyBalances[:-1]
+
     def getMaxDrawdown(self) -> float:
-        maxDrawdown = 0
-        dailyBalances = list(self.balancePerDay.values())
-        for idx, balance in enumerate(dailyBalances):
-            maxDrawdown = max(maxDrawdown, 1 - balance / max(dailyBalances[: idx + 1]))
-        return maxDrawdown * 100
-
-    def getDailyReturns(self) -> list[float]:
-        return {
-            date: (self.balancePerDay[date] - self.balancePerDay[previousDate])
-            / self.balancePerDay[previousDate]
-            for date, previousDate in zip(
-                list(self.balancePerDay.keys())[1:],
-                list(self.balancePerDay.keys())[:-1],
-            )
-        }
-
-    def getDailyReturnsWithoutContributions(self) -> list[float]:
-        return {
-            date: (
-                self.balancePerDay[date]
-                - self.balancePerDay[previousDate]
-                - self.contributionsPerDay[date]
-            )
-            / self.balancePerDay[previousDate]
-            for date, previousDate in zip(
-                list(self.balancePerDay.keys())[1:],
-                list(self.balancePerDay.keys())[:-1],
-            )
-        }
+        runningMaxBalances = np.maximum.accumulate(self.dailyBalances)
+        return float(np.max(1 - self.dailyBalances / runningMaxBalances)) * 100
+
+    def getDailyReturns(self) -> Dict[datetime.date, float]:
+        return dict(zip(self.dates[1:], self.dailyReturns.tolist()))
+
+    def getDailyReturnsWithoutContributions(self) -> Dict[datetime.date, float]:
+        return dict(zip(self.dates[1:], self.dailyReturnsWithoutContributions.tolist()))
 
     def getMeanDailyReturn(self) -> float:
-        return sum(self.getDailyReturns().values()) / len(self.getDailyReturns())
+        return float(np.mean(self.dailyReturns))
 
     def getMeanDailyReturnWithoutContributions(self) -> float:
-        return sum(self.getDailyReturnsWithoutContributions().values()) / len(
-            self.getDailyReturnsWithoutContributions()
-        )
+        return float(np.mean(self.dailyReturnsWithoutContributions))
+
+    @cached_property
+    def returnsStandardDeviation(self) -> float:
+        return float(np.std(self.dailyReturns))
 
     def getReturnsStandardDeviation(self) -> float:
-        dailyReturns = self.getDailyReturns().values()
-        mean = sum(dailyReturns) / len(dailyReturns)
-        return (sum((x - mean) ** 2 for x in dailyReturns) / len(dailyReturns)) ** 0.5
+        return self.returnsStandardDeviation
 
     def getSharpeRatio(self) -> float:
         return self.getMeanDailyReturn() / self.getReturnsStandardDeviation() * 250**0.5
@@ -101,66 +120,80 @@ class SimulationResult:
     def getTotalContributions(self) -> float:
         return sum(self.contributionsPerDay.values())
 
-    def getAverageLeverage(self) -> float:
-        return sum(
+    @cached_property
+    def basketValues(self) -> Tuple[List[str], np.ndarray, np.ndarray]:
+        dates = list(self.basketsPerDay)
+        baskets = list(self.basketsPerDay.values())
+        instruments = list(
+            dict.fromkeys(
+                stockName for basket in baskets for stockName in basket.stockPositions
+            )
+        )
+        positions = np.array(
+            [
+                [basket.stockPositions.get(stockName, 0) for stockName in instruments]
+                for basket in baskets
+            ],
+            dtype=np.float64,
+        ).reshape(len(dates), len(instruments))
+        # Only instruments in a day's basket are priced, so an instrument held
+        # on other days may have no price row on that date.
+        isHeld = np.array(
             [
-                basket.getLeverage(date=date)
-                for date, basket in self.basketsPerDay.items()
-            ]
-        ) / len(self.basketsPerDay)
+                [stockName in basket.stockPositions for stockName in instruments]
+                for basket in baskets
+            ],
+            dtype=bool,
+        ).reshape(len(dates), len(instruments))
+        prices = np.zeros_like(positions)
+        for column, stockName in enumerate(instruments):
+            rows = np.flatnonzero(isHeld[:, column])
+            heldDates = [dates[row] for row in rows.tolist()]
+            prices[rows, column] = getStockPricesForDates(
+                stockName, heldDates
+            ) + getDividendsForDates(stockName, heldDates)
+        cash = np.fromiter(
+            (basket.cash for basket in baskets), dtype=np.float64, count=len(dates)
+        )
+        return instruments, positions * prices, cash
+
+    def getAverageExposureOfType(self, instrumentType: str) -> float:
+        instruments, positionValues, cash = self.basketValues
+        isOfType = getInstrumentTypeMask(tuple(instruments), instrumentType)
+        totalValues = positionValues.sum(axis=1) + cash
+        return float(np.mean(positionValues[:, isOfType].sum(axis=1) / totalValues))
+
+    def getAverageLeverage(self) -> float:
+        _, positionValues, cash = self.basketValues
+        totalValues = positionValues.sum(axis=1) + cash
+        return float(np.mean(1.0 - cash / totalValues))
 
     def getAverageEquityExposure(self) -> float:
-        return sum(
-            [
-                sum(basket.getEquityExposures(date=date).values())
-                for date, basket in self.basketsPerDay.items()
-            ]
-        ) / len(self.basketsPerDay)
+        return self.getAverageExposureOfType("Equity")
 
     def getAverageBondExposure(self) -> float:
-        return sum(
-            [
-                sum(basket.getBondExposures(date=date).values())
-                for date, basket in self.basketsPerDay.items()
-            ]
-        ) / len(self.basketsPerDay)
+        return self.getAverageExposureOfType("Bond")
 
     def getAverageCommodityExposure(self) -> float:
-        return sum(
-            [
-                sum(basket.getCommodityExposures(date=date).values())
-                for date, basket in self.basketsPerDay.items()
-            ]
-        ) / len(self.basketsPerDay)
+        return self.getAverageExposureOfType("Commodity")
 
     def getWorstDays(
         self, n: int = 10
     ) -> List[Tuple[datetime.date, float, Tuple[float, float]]]:
-        return sorted(
-            [
-                (date, loss, (balance, previousBalance))
-                for date, loss, balance, previousBalance in zip(
-                    list(self.balancePerDay.keys())[1:],
-                    [
-                        1 - bal / previousBal
-                        for bal, previousBal in zip(
-                            list(self.balancePerDay.values())[1:],
-                            list(self.balancePerDay.values())[:-1],
-                        )
-                    ],
-                    list(self.balancePerDay.values())[1:],
-                    list(self.balancePerDay.values())[:-1],
-                )
-            ],
-            key=lambda x: x[2][0] / x[2][1],
-        )[:n]
+        dates = self.dates
+        balances = self.dailyBalances.tolist()
+        ratios = self.dailyBalances[1:] / self.dailyBalances[:-1]
+        return [
+            (dates[idx + 1], 1 - ratios[idx].item(), (balances[idx + 1], balances[idx]))
+            for idx in np.argsort(ratios, kind="stable")[:n].tolist()
+        ]
 
     def __str__(self) -> str:
         return f"""
         Initial balance: {self.initialBalance:.2f}
         End balance: {self.endBalance:.2f}
         CARG: {self.getCARG():.2f}%
-        Mean daily return: {sum(self.getDailyReturns().values()) / len(self.getDailyReturns()) * 100:.2f}%
+        Mean daily return: {self.getMeanDailyReturn() * 100:.2f}%
         Return standard deviation: {self.getReturnsStandardDeviation() * 100:.2f}%
         Sharpe ratio: {self.getSharpeRatio():.2f}
         Max drawdown: {self.getMaxDrawdown():.2f}%
@@ -176,6 +209,55 @@ class SimulationResult:
         """
 
 
+@njit(cache=True)
+def simulateConstantExposures(
+    prices: np.ndarray,
+    dividends: np.ndarray,
+    exposures: np.ndarray,
+    contributions: np.ndarray,
+    depositGrowthFactors: np.ndarray,
+    borrowingGrowthFactors: np.ndarray,
+    initialBalance: float,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Same arithmetic as rebalancing through getBasketFromStockExposures every
+    # day, with contributions and growth factors indexed from the second day.
+    numberOfDays, numberOfStocks = prices.shape
+    balances = np.empty(numberOfDays)
+    cash = np.empty(numberOfDays)
+    positions = np.empty((numberOfDays, numberOfStocks))
+    basketValue = initialBalance
+    for day in range(numberOfDays):
+        if day > 0:
+            basketValue = 0.0
+            for stock in range(numberOfStocks):
+                basketValue += positions[day - 1, stock] * (
+                    prices[day, stock] + dividends[day, stock]
+                )
+            basketValue += cash[day - 1]
+
+        dayCash = basketValue
+        for stock in range(numberOfStocks):
+            stockValue = basketValue * exposures[stock]
+            positions[day, stock] = stockValue / prices[day, stock]
+            dayCash -= stockValue
+
+        if day > 0:
+            dayCash += contributions[day - 1]
+            dayCash *= (
+                depositGrowthFactors[day - 1]
+                if dayCash > 0
+                else borrowingGrowthFactors[day - 1]
+            )
+
+        balance = 0.0
+        for stock in range(numberOfStocks):
+            balance += positions[day, stock] * prices[day, stock]
+        balances[day] = balance + dayCash
+        cash[day] = dayCash
+
+    return balances, cash, positions
+
+
 def simulate(
     strategy: Strategy,
     startDate,
@@ -187,16 +269,29 @@ def simulate(
         getStockTradingDays(stockName=inst, startDate=startDate, endDate=endDate)
         for inst in strategy.tradingDaysMustHaveInstruments
     ]
-    tradingDays = [
-        day
-        for day in tradingDays[0]
-        if all(day in tradingDays[i] for i in range(1, len(tradingDays)))
-    ]
+    tradingDays = intersectTradingDays(tradingDays)
 
     print(
         f"Trading days: {len(tradingDays)}, start date: {tradingDays[0]}, end date: {tradingDays[-1]}"
     )
 
+    interestRates = getPrices("fedFundsRate", tradingDays[1:]) / 100
+    depositGrowthFactors = 1 + (interestRates - SPREAD) / 250
+    borrowingGrowthFactors = 1 + (interestRates + SPREAD) / 250
+
+    if (
+        isinstance(strategy, ConstantExposuresStrategy)
+        and sum(strategy.stockExposures.values()) != 0
+    ):
+        return simulateWithConstantExposures(
+            strategy=strategy,
+            tradingDays=tradingDays,
+            initialBalance=initialBalance,
+            dailyIncome=dailyIncome,
+            depositGrowthFactors=depositGrowthFactors,
+            borrowingGrowthFactors=borrowingGrowthFactors,
+        )
+
     basket = strategy.getPositionsFromBasket(
         date=tradingDays[0],
         currentBasket=Basket(cash=initialBalance, date=tradingDays[0]),
@@ -210,22 +305,27 @@ def simulate(
 
     contributionsPerDay = {tradingDays[0]: 0}
 
-    for date in tqdm(tradingDays[1:], desc="Simulating"):
+    for date, depositGrowth, borrowingGrowth in zip(
+        tqdm(
+            tradingDays[1:],
+            desc="Simulating",
+            mininterval=0.5,
+            miniters=max(1, len(tradingDays) // 200),
+        ),
+        depositGrowthFactors.tolist(),
+        borrowingGrowthFactors.tolist(),
+    ):
         basket = strategy.getPositionsFromBasket(date=date, currentBasket=basket)
-        basket.cash += dailyIncome(date=date)
-        interestRate = getPrices("fedFundsRate", [date])[0] / 100
-        basket.cash *= (
-            (1 + (interestRate - SPREAD) / 250)
-            if basket.cash > 0
-            else (1 + (interestRate + SPREAD) / 250)
-        )
+        contribution = dailyIncome(date=date)
+        basket.cash += contribution
+        basket.cash *= depositGrowth if basket.cash > 0 else borrowingGrowth
         balancePerDay[date] = basket.getCashValue(date)
         basketsPerDay[date] = basket
-        contributionsPerDay[date] = dailyIncome(date=date)
+        contributionsPerDay[date] = contribution
 
     return SimulationResult(
         initialBalance=initialBalance,
-        endBalance=basket.getCashValue(tradingDays[-1]),
+        endBalance=balancePerDay[tradingDays[-1]],
         startDate=tradingDays[0],
         endDate=tradingDays[-1],
         balancePerDay=balancePerDay,
@@ -233,3 +333,51 @@ def simulate(
         contributionsPerDay=contributionsPerDay,
         strategy=strategy,
     )
+
+
+def simulateWithConstantExposures(
+    strategy: ConstantExposuresStrategy,
+    tradingDays: List[datetime.date],
+    initialBalance: float,
+    dailyIncome: Callable,
+    depositGrowthFactors: np.ndarray,
+    borrowingGrowthFactors: np.ndarray,
+) -> SimulationResult:
+    instruments = list(strategy.stockExposures)
+    contributions = [dailyIncome(date=date) for date in tradingDays[1:]]
+    balances, cash, positions = simulateConstantExposures(
+        prices=np.column_stack(
+            [getStockPricesForDates(name, tradingDays) for name in instruments]
+        ).astype(np.float64),
+        dividends=np.column_stack(
+            [getDividendsForDates(name, tradingDays) for name in instruments]
+        ).astype(np.float64),
+        exposures=np.array(list(strategy.stockExposures.values()), dtype=np.float64),
+        contributions=np.array(contributions, dtype=np.float64),
+        depositGrowthFactors=depositGrowthFactors,
+        borrowingGrowthFactors=borrowingGrowthFactors,
+        initialBalance=float(initialBalance),
+    )
+
+    return SimulationResult(
+        initialBalance=initialBalance,
+        endBalance=balances[-1].item(),
+        startDate=tradingDays[0],
+        endDate=tradingDays[-1],
+        balancePerDay=dict(zip(tradingDays, balances.tolist())),
+        basketsPerDay={
+            date: Basket(
+                stockPositions=dict(zip(instruments, dayPositions)),
+                cash=dayCash,
+                date=date,
+            )
+            for date, dayPositions, dayCash in zip(
+                tradingDays, positions.tolist(), cash.tolist()
+            )
+        },
+        contributionsPerDay={
+            tradingDays[0]: 0,
+            **dict(zip(tradingDays[1:], contributions)),
+        },
+        strategy=strategy,
+    )
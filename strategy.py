@@ -1,13 +1,25 @@
 import datetime
 from collections import defaultdict
+from functools import lru_cache
+from itertools import compress
 from typing import Dict, List, Optional, Tuple
 
+import numpy as np
+
 from stocksInfo import INSTRUMENT_TYPES
 from utils import getDividendForDate, getStockPriceForDate, isStockTradingDay
 
 CASH: str = "Cash"
 
 
+@lru_cache
+def getInstrumentTypeMask(stockNames: Tuple[str, ...], instrumentType: str):
+    return np.array(
+        [INSTRUMENT_TYPES.get(name) == instrumentType for name in stockNames],
+        dtype=bool,
+    )
+
+
 class Basket:
     def __init__(
         self,
@@ -25,17 +37,36 @@ class Basket:
 
     def getCashValue(self, date, adjustForDividends: bool = False):
         return (
-            sum(
-                self.getPositionValue(
-                    stockName=stockName,
-                    date=date,
-                    adjustForDividends=adjustForDividends,
+            float(
+                np.sum(
+                    self.getPositionValues(
+                        date=date, adjustForDividends=adjustForDividends
+                    )
                 )
-                for stockName in self.stockPositions
             )
             + self.cash
         )
 
+    def getPositionValues(self, date, adjustForDividends: bool = False) -> np.ndarray:
+        numberOfStocks = len(self.stockPositions)
+        positions = np.fromiter(
+            self.stockPositions.values(), dtype=np.float64, count=numberOfStocks
+        )
+        prices = np.fromiter(
+            (
+                getStockPriceForDate(stockName=stockName, date=date)
+                + (
+                    getDividendForDate(stockName=stockName, date=date)
+                    if adjustForDividends
+                    else 0
+                )
+                for stockName in self.stockPositions
+            ),
+            dtype=np.float64,
+            count=numberOfStocks,
+        )
+        return positions * prices
+
     def getPositionValue(self, stockName, date, adjustForDividends: bool = False):
         return self.stockPositions[stockName] * (
             getStockPriceForDate(stockName=stockName, date=date)
@@ -65,14 +96,11 @@ class Basket:
         """
 
     def getExposures(self, date: datetime.datetime):
-        totalValue = self.getCashValue(date=date, adjustForDividends=True)
-        exposures = {
-            stockName: self.getPositionValue(
-                stockName=stockName, date=date, adjustForDividends=True
-            )
-            / totalValue
-            for stockName in self.stockPositions
-        }
+        positionValues = self.getPositionValues(date=date, adjustForDividends=True)
+        totalValue = float(np.sum(positionValues)) + self.cash
+        exposures = dict(
+            zip(self.stockPositions, (positionValues / totalValue).tolist())
+        )
 
         exposures[CASH] = self.cash / totalValue
         return exposures
@@ -80,26 +108,26 @@ class Basket:
     def getLeverage(self, date: datetime.datetime):
         return 1.0 - self.cash / self.getCashValue(date=date, adjustForDividends=True)
 
+    def getExposuresOfType(self, date: datetime.datetime, instrumentType: str):
+        stockNames = tuple(self.stockPositions)
+        isOfType = getInstrumentTypeMask(stockNames, instrumentType)
+        positionValues = self.getPositionValues(date=date, adjustForDividends=True)
+        totalValue = float(np.sum(positionValues)) + self.cash
+        return dict(
+            zip(
+                compress(stockNames, isOfType),
+                (positionValues[isOfType] / totalValue).tolist(),
+            )
+        )
+
     def getEquityExposures(self, date: datetime.datetime):
-        return {
-            name: exposure
-            for name, exposure in self.getExposures(date=date).items()
-            if INSTRUMENT_TYPES.get(name) == "Equity"
-        }
+        return self.getExposuresOfType(date=date, instrumentType="Equity")
 
     def getBondExposures(self, date: datetime.datetime):
-        return {
-            name: exposure
-            for name, exposure in self.getExposures(date=date).items()
-            if INSTRUMENT_TYPES.get(name) == "Bond"
-        }
+        return self.getExposuresOfType(date=date, instrumentType="Bond")
 
     def getCommodityExposures(self, date: datetime.datetime):
-        return {
-            name: exposure
-            for name, exposure in self.getExposures(date=date).items()
-            if INSTRUMENT_TYPES.get(name) == "Commodity"
-        }
+        return self.getExposuresOfType(date=date, instrumentType="Commodity")
 
 
 def getBasketFromStockValues(
@@ -132,14 +160,24 @@ def getBasketFromStockExposures(
     skipNotTraded: bool = False,
 ) -> Basket:
     basket = Basket(cash=basketValue, date=date)
+    stockNames = list(stockExposures)
+    exposures = np.fromiter(
+        stockExposures.values(), dtype=np.float64, count=len(stockNames)
+    )
     totalExporsures = sum(stockExposures.values())
-    tradedExposure = 0
-
-    for stockName, stockExposure in stockExposures.items():
-        if skipNotTraded and not isStockTradingDay(stockName=stockName, date=date):
-            continue
 
-        tradedExposure += stockExposure
+    if skipNotTraded:
+        isTraded = np.fromiter(
+            (
+                isStockTradingDay(stockName=stockName, date=date)
+                for stockName in stockNames
+            ),
+            dtype=bool,
+            count=len(stockNames),
+        )
+        stockNames = [name for name, traded in zip(stockNames, isTraded) if traded]
+        exposures = exposures[isTraded]
+    tradedExposure = sum(stockExposures[stockName] for stockName in stockNames)
 
     if tradedExposure != totalExporsures and not skipNotTraded:
         raise ValueError(
@@ -151,15 +189,20 @@ def getBasketFromStockExposures(
             f"Total exposure is {totalExporsures}, traded exposure is {tradedExposure}"
         )
 
-    for stockName, stockExposure in stockExposures.items():
-        if skipNotTraded and not isStockTradingDay(stockName=stockName, date=date):
-            continue
-
-        stockValue = basketValue * stockExposure * (totalExporsures / tradedExposure)
-        basket.stockPositions[stockName] = stockValue / getStockPriceForDate(
-            stockName=stockName, date=date
-        )
-        basket.cash -= stockValue
+    prices = np.fromiter(
+        (
+            getStockPriceForDate(stockName=stockName, date=date)
+            for stockName in stockNames
+        ),
+        dtype=np.float64,
+        count=len(stockNames),
+    )
+    stockValues = basketValue * exposures * (totalExporsures / tradedExposure)
+    basket.stockPositions.update(zip(stockNames, (stockValues / prices).tolist()))
+    # subtract.reduce runs left to right, matching one subtraction per stock.
+    basket.cash = np.subtract.reduce(
+        np.concatenate(([basketValue], stockValues))
+    ).item()
 
     return basket
 
@@ -1,62 +1,162 @@
 import datetime
 import os
-from copy import deepcopy
-from functools import cache
-from typing import Dict, List
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache, lru_cache
+from typing import Dict, List, Tuple
 
 import numpy as np
 import pandas as pd
 import yfinance as yf
-
-import warnings
-
-warnings.filterwarnings("ignore")
+from joblib import Memory
 
 LOCAL_PATH = ""
+CACHE_PATH = os.path.join(
+    LOCAL_PATH or os.path.dirname(os.path.abspath(__file__)), ".cache"
+)
+DISK_CACHE = Memory(CACHE_PATH, verbose=0)
+STOCK_PRICES_PATH = os.path.join(CACHE_PATH, "stockPrices")
 
 
-@cache
-def getAllStockPrices(stockName):
+def downloadStockPrices(stockName):
     START_DATE = datetime.datetime.now() + datetime.timedelta(days=-100000)
     END_DATE = datetime.datetime.now() + datetime.timedelta(days=1)
     ticker = yf.Ticker(stockName)
-    data = ticker.history(end=END_DATE, start=START_DATE)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        data = ticker.history(end=END_DATE, start=START_DATE)
     data.index = data.index.date
     return data
 
 
+def loadStockPrices(stockName) -> pd.DataFrame:
+    # One file per ticker, refreshed by the first run of each day.
+    path = os.path.join(STOCK_PRICES_PATH, f"{stockName}.pkl")
+    if (
+        os.path.exists(path)
+        and datetime.date.fromtimestamp(os.path.getmtime(path)) == datetime.date.today()
+    ):
+        return pd.read_pickle(path)
+
+    data = downloadStockPrices(stockName)
+    os.makedirs(STOCK_PRICES_PATH, exist_ok=True)
+    temporaryPath = f"{path}.{os.getpid()}.tmp"
+    data.to_pickle(temporaryPath)
+    os.replace(temporaryPath, path)
+    return data
+
+
+STOCK_PRICES: Dict[str, pd.DataFrame] = {}
+
+
+def getAllStockPrices(stockName):
+    if stockName not in STOCK_PRICES:
+        STOCK_PRICES[stockName] = loadStockPrices(stockName)
+    return STOCK_PRICES[stockName]
+
+
+def preloadStockPrices(stockNames):
+    # Downloads are network bound, so fetch every missing history at once.
+    missingNames = [
+        stockName
+        for stockName in dict.fromkeys(stockNames)
+        if stockName not in STOCK_PRICES
+    ]
+    if not missingNames:
+        return
+
+    # catch_warnings is not thread safe. Ignoring warnings here first means
+    # every filter list the download threads save and restore starts with
+    # the same ignore entry, and the original filters come back at the end.
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        with ThreadPoolExecutor(max_workers=len(missingNames)) as executor:
+            STOCK_PRICES.update(
+                zip(missingNames, executor.map(loadStockPrices, missingNames))
+            )
+
+
+UNIX_EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+
+def getDateOrdinals(dates) -> np.ndarray:
+    if isinstance(dates, np.ndarray) and dates.dtype.kind == "M":
+        return dates.astype("datetime64[D]").astype(np.int64) + UNIX_EPOCH_ORDINAL
+    return np.fromiter((date.toordinal() for date in dates), dtype=np.int64)
+
+
 @cache
-def getStockPriceForDate(stockName, date):
-    data = getAllStockPrices(stockName=stockName)
-    return data.loc[date]["Close"]
+def getStockDateOrdinals(stockName) -> np.ndarray:
+    return getDateOrdinals(getAllStockPrices(stockName).index)
+
+
+def toDate(value):
+    return value.date() if isinstance(value, datetime.datetime) else value
+
+
+def getStockRowRange(stockName, startDate, endDate) -> Tuple[int, int]:
+    start, end = np.searchsorted(
+        getStockDateOrdinals(stockName), [startDate.toordinal(), endDate.toordinal()]
+    )
+    return int(start), int(end)
 
 
 @cache
-def getDividendForDate(stockName, date):
-    data = getAllStockPrices(stockName=stockName)
-    return data.loc[date]["Dividends"]
+def getStockDateIndices(stockName) -> Dict[datetime.date, int]:
+    data = getAllStockPrices(stockName)
+    return {date: idx for idx, date in enumerate(data.index)}
 
 
 @cache
+def getStockColumn(stockName, column: str) -> np.ndarray:
+    return getAllStockPrices(stockName)[column].to_numpy()
+
+
+def getStockRowsForDates(stockName, dates) -> np.ndarray:
+    dateIndices = getStockDateIndices(stockName)
+    return np.fromiter((dateIndices[date] for date in dates), dtype=np.intp)
+
+
+def getStockPriceForDate(stockName, date):
+    return getStockColumn(stockName, "Close")[getStockDateIndices(stockName)[date]]
+
+
+def getStockPricesForDates(stockName, dates) -> np.ndarray:
+    return getStockColumn(stockName, "Close")[getStockRowsForDates(stockName, dates)]
+
+
+def getDividendForDate(stockName, date):
+    return getStockColumn(stockName, "Dividends")[getStockDateIndices(stockName)[date]]
+
+
+def getDividendsForDates(stockName, dates) -> np.ndarray:
+    return getStockColumn(stockName, "Dividends")[
+        getStockRowsForDates(stockName, dates)
+    ]
+
+
 def getStockPrices(stockName, numDays, endDate):
-    startDate = endDate + datetime.timedelta(days=-2 * numDays - 20)
-    ticker = yf.Ticker(stockName)
-    print(f"Getting stock prices for {stockName} from {startDate} to {endDate}")
-    data = ticker.history(end=endDate, start=startDate, keepna=True)
+    return getStockPricesCached(stockName, numDays, toDate(endDate))
 
-    print(f"Got stock prices for {stockName} from {startDate} to {endDate}")
-    print(f"Data is {data}")
 
-    return data["Close"][-numDays:]
+@lru_cache(maxsize=128)
+def getStockPricesCached(stockName, numDays, endDate):
+    startDate = endDate + datetime.timedelta(days=-2 * numDays - 20)
+    start, end = getStockRowRange(stockName, startDate, endDate)
+    return getStockColumn(stockName, "Close")[max(start, end - numDays) : end]
 
 
-@cache
 def getVolatility(stockName, numDays, endDate):
+    return getVolatilityCached(stockName, numDays, toDate(endDate))
+
+
+@lru_cache(maxsize=128)
+def getVolatilityCached(stockName, numDays, endDate):
     startDate = endDate + datetime.timedelta(days=-2 * numDays)
-    ticker = yf.Ticker(stockName)
-    data = ticker.history(end=endDate, start=startDate)
+    start, end = getStockRowRange(stockName, startDate, endDate)
+    closes = getStockColumn(stockName, "Close")[max(start, end - numDays - 1) : end]
 
-    stockChanges = np.diff(data["Close"])[-numDays:]
+    stockChanges = np.diff(closes)
     volatility = np.std(stockChanges)
     return volatility
 
@@ -64,69 +164,83 @@ def getVolatility(stockName, numDays, endDate):
 def getInverseVolatilityPositions(
     stockNames: List[str], numDays, endDate, coeficients: Dict = None
 ) -> Dict[str, float]:
+    preloadStockPrices(stockNames)
     volatilities = [
         getVolatility(stockName=stockName, numDays=numDays, endDate=endDate)
         for stockName in stockNames
     ]
-    inverseVolatilities = [1 / i for i in volatilities]
-    if coeficients is None:
-        return {
-            stockName: i / sum(inverseVolatilities)
-            for stockName, i in zip(stockNames, inverseVolatilities)
-        }
-    else:
-        totalPosition = sum(
-            coeficients[i] * u for i, u in zip(stockNames, inverseVolatilities)
+    inverseVolatilities = 1 / np.array(volatilities, dtype=np.float64)
+    if coeficients is not None:
+        inverseVolatilities *= np.array(
+            [coeficients[stockName] for stockName in stockNames], dtype=np.float64
         )
-        return {
-            stockName: coeficients[stockName] * inverseVolatility / totalPosition
-            for stockName, inverseVolatility in zip(stockNames, inverseVolatilities)
-        }
+
+    return dict(
+        zip(stockNames, (inverseVolatilities / np.sum(inverseVolatilities)).tolist())
+    )
 
 
-@cache
 def getStockTradingDays(stockName, startDate, endDate):
-    ticker = yf.Ticker(stockName)
-    data = ticker.history(end=endDate, start=startDate)
-    return [i.date() for i in data.index]
+    return getStockTradingDaysCached(stockName, toDate(startDate), toDate(endDate))
+
+
+@lru_cache(maxsize=128)
+def getStockTradingDaysCached(stockName, startDate, endDate):
+    start, end = getStockRowRange(stockName, startDate, endDate)
+    return getAllStockTradingDays(stockName)[start:end]
 
 
 @cache
 def getAllStockTradingDays(stockName):
-    START_DATE = datetime.datetime.now() + datetime.timedelta(days=-100000)
-    END_DATE = datetime.datetime.now() + datetime.timedelta(days=1)
-    ticker = yf.Ticker(stockName)
-    data = ticker.history(end=END_DATE, start=START_DATE)
-    return [i.date() for i in data.index]
+    return getAllStockPrices(stockName).index.tolist()
+
+
+def intersectTradingDays(tradingDays: List[List]) -> List:
+    commonDays = set(tradingDays[0]).intersection(*tradingDays[1:])
+    return [day for day in tradingDays[0] if day in commonDays]
 
 
 def isStockTradingDay(stockName, date):
-    return date in getAllStockTradingDays(stockName)
+    return date in getStockDateIndices(stockName)
 
 
 @cache
 def getEconomicData(filename: str) -> pd.DataFrame:
     path = os.path.join(f"{LOCAL_PATH}/economicsData", filename)
-    data = pd.read_csv(path, index_col=0, parse_dates=True)
-    data.index = pd.to_datetime(data.index).date
+    data = pd.read_csv(path, index_col=0, parse_dates=True, date_format="%Y-%m-%d")
+    data.index = data.index.date
     data["data"] = pd.to_numeric(data["data"], errors="coerce").ffill()
 
     return data
 
 
-@cache
 def getEconomicDataDates(filename: str, startDate, endDate) -> List[datetime.datetime]:
-    dates = getEconomicData(filename=filename).index.to_list()
-    start, end = max(startDate, dates[0]), min(dates[-1], endDate)
-    results = []
-    while start <= end:
-        results.append(deepcopy(start))
-        start += datetime.timedelta(days=1)
+    return getEconomicDataDatesCached(filename, toDate(startDate), toDate(endDate))
 
-    return results
+
+@lru_cache(maxsize=128)
+def getEconomicDataDatesCached(
+    filename: str, startDate, endDate
+) -> List[datetime.datetime]:
+    dates = getEconomicData(filename=filename).index
+    start, end = max(startDate, dates[0]), min(dates[-1], endDate)
+    return [start + datetime.timedelta(days=i) for i in range((end - start).days + 1)]
 
 
 @cache
-def getEconomicDataForDate(date: datetime.datetime, filename: str) -> float:
+def getEconomicDataArrays(filename: str) -> Tuple[np.ndarray, np.ndarray]:
     data = getEconomicData(filename=filename)
-    return float(data[data.index <= date].iloc[-1])
+    return getDateOrdinals(data.index), data["data"].to_numpy()
+
+
+def getEconomicDataForDates(dates, filename: str) -> np.ndarray:
+    dataOrdinals, values = getEconomicDataArrays(filename=filename)
+    rows = np.searchsorted(dataOrdinals, getDateOrdinals(dates), side="right") - 1
+    if len(rows) and rows.min() < 0:
+        raise IndexError(f"No {filename} data on or before {min(dates)}")
+    return values[rows]
+
+
+@lru_cache(maxsize=4096)
+def getEconomicDataForDate(date: datetime.datetime, filename: str) -> float:
+    return float(getEconomicDataForDates([date], filename=filename)[0])